@@ -0,0 +1,73 @@
+import hashlib
+import threading
+import time
+from typing import NamedTuple
+from cachetools import TTLCache
+
+# Short TTL: a revoked/changed user is seen again within seconds, while bursts of
+# requests from the same client skip JWT verification and the user lookup
+AUTH_CACHE_MAXSIZE = 10_000
+AUTH_CACHE_TTL = 5 # seconds
+
+
+
+class CurrentUser(NamedTuple):
+    """
+    Immutable snapshot of an authenticated user. Unlike an ORM User, which belongs to the session
+    that loaded it, it can be shared between requests. Use db.get(models.User, user.id) where an
+    attached entity is needed.
+    """
+    id: int
+    username: str
+    role: str
+
+
+# sha256(token) -> (CurrentUser, deadline). The deadline is the earlier of the TTL and the token's
+# own exp, so an entry never outlives the token it was built from.
+_cache = TTLCache(maxsize=AUTH_CACHE_MAXSIZE, ttl=AUTH_CACHE_TTL)
+# sha256(token) of tokens that just failed verification. Kept only briefly: it exists to absorb
+# bursts of the same bad token, not to remember rejections
+REJECTED_CACHE_TTL = 1 # seconds
+_rejected = TTLCache(maxsize=AUTH_CACHE_MAXSIZE, ttl=REJECTED_CACHE_TTL)
+_lock = threading.Lock()
+
+
+def _key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def get_user(token: str) -> CurrentUser | None:
+    """Returns the cached user for a token verified in the last few seconds, or None."""
+    key = _key(token)
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        user, deadline = entry
+        if time.time() >= deadline:
+            del _cache[key]
+            return None
+        return user
+
+
+def put_user(token: str, user: CurrentUser, exp: float | None):
+    """Caches the user resolved from a successfully verified token. Never call this for failures."""
+    deadline = time.time() + AUTH_CACHE_TTL
+    if exp is not None:
+        deadline = min(deadline, exp)
+    with _lock:
+        _cache[_key(token)] = (user, deadline)
+
+
+def is_rejected(token: str) -> bool:
+    """True if this exact token failed verification within the last REJECTED_CACHE_TTL seconds."""
+    key = _key(token)
+    with _lock:
+        return key in _rejected
+
+
+def put_rejected(token: str):
+    """Remembers a token that failed verification so repeats are refused without decoding it."""
+    key = _key(token)
+    with _lock:
+        _rejected[key] = True
@@ -0,0 +1,66 @@
+import asyncio
+
+# Defaults sized for FAISS/ONNX work: big enough batches to amortize per-call setup,
+# short enough waits that a lone request barely notices
+DEFAULT_MAX_BATCH = 32
+DEFAULT_MAX_DELAY = 0.005 # seconds
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted by concurrent coroutines into batches for a blocking batch function.
+    A batch is flushed when it reaches max_batch items or max_delay seconds after its first item,
+    and batch_fn runs in a worker thread (or the given executor) so the event loop stays responsive.
+    """
+
+    def __init__(self, batch_fn, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY, executor=None):
+        """
+        :param batch_fn: Callable taking a list of items and returning a list of results in the same order.
+        :param max_batch: Maximum number of items per batch_fn call.
+        :param max_delay: Maximum time (seconds) the first item of a batch waits for company.
+        :param executor: Executor to run batch_fn in (None: the loop's default thread pool). With a
+                         process pool, batch_fn and the items must be picklable.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.executor = executor
+        self._items = []
+        self._futures = []
+        self._flush_handle = None
+        self._tasks = set() # Keeps running batches referenced until they finish
+
+    async def submit(self, item):
+        """Adds an item to the pending batch and waits for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._items.append(item)
+        self._futures.append(future)
+        if len(self._items) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        items, futures = self._items, self._futures
+        self._items, self._futures = [], []
+        if items:
+            task = asyncio.get_running_loop().create_task(self._run_batch(items, futures))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, items, futures):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.batch_fn, items)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done(): # The awaiting request may have been cancelled
+                future.set_result(result)
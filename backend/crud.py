@@ -1,114 +1,222 @@
-from sqlalchemy.orm import Session
+import asyncio
+import os
+from sqlalchemy import bindparam, exists, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
 import models, schemas
 from passlib.context import CryptContext
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# Users
+# argon2id with OWASP interactive parameters (t=2, m=19 MiB, p=1) for new hashes;
+# existing bcrypt hashes still verify and are flagged for rehash.
+ARGON2_TIME_COST = 2
+ARGON2_MEMORY_COST = 19456 # KiB
+ARGON2_PARALLELISM = 1
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
+
+# Password hashing runs in worker threads so it doesn't block the event loop;
+# cap concurrent hashes at the core count to avoid CPU thrashing under signup bursts.
+_hash_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+async def hash_password(password: str) -> str:
+    async with _hash_semaphore:
+        return await asyncio.to_thread(pwd_context.hash, password)
+
+async def verify_and_update_password(password: str, hashed_password: str) -> tuple[bool, str | None]:
+    async with _hash_semaphore:
+        return await asyncio.to_thread(pwd_context.verify_and_update, password, hashed_password)
+
+def _insert_ignore(db: AsyncSession, model):
+    """INSERT that skips rows conflicting with a unique/primary key (PostgreSQL and SQLite)."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return insert(model)
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+# Users
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed = pwd_context.hash(user.password)
+# Built once at import; SQLAlchemy's compiled cache then reuses it on every call.
+# users.username has a unique index, so this is a single index probe.
+_USER_BY_USERNAME_STMT = select(models.User).where(models.User.username == bindparam("username"))
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    return (await db.execute(_USER_BY_USERNAME_STMT, {"username": username})).scalar_one_or_none()
+
+# Relationships serialized by schemas.UserRead. Lazy loads are not possible under AsyncSession.
+_USER_READ_LOADERS = (
+    selectinload(models.User.taught_lessons),
+    selectinload(models.User.lesson_enrollments).joinedload(models.StudentLessonEnrollment.lesson),
+)
+
+async def get_users(db: AsyncSession, after_id: int | None = None, limit: int = 100) -> list[models.User]:
+    """Keyset-paginated users ordered by id: the page of up to `limit` users with id > after_id."""
+    stmt = select(models.User).options(*_USER_READ_LOADERS).order_by(models.User.id).limit(limit)
+    if after_id is not None:
+        stmt = stmt.where(models.User.id > after_id)
+    return (await db.scalars(stmt)).all()
+
+async def get_student_ids(db: AsyncSession, user_ids: set[int]) -> set[int]:
+    """Returns the subset of user_ids that exist and have the 'student' role."""
+    stmt = select(models.User.id).where(models.User.id.in_(user_ids), models.User.role == 'student')
+    return set((await db.scalars(stmt)).all())
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    hashed = await hash_password(user.password)
     db_user = models.User(username=user.username, hashed_password=hashed, role=user.role)
-    db.add(db_user); db.commit(); db.refresh(db_user)
+    db.add(db_user); await db.commit()
+    await db.refresh(db_user, attribute_names=["taught_lessons", "lesson_enrollments"])
     return db_user
 
 # Attendance
 
-def create_attendance(db: Session, user_id: int, att: schemas.AttendanceCreate):
+async def create_attendance(db: AsyncSession, user_id: int, att: schemas.AttendanceCreate):
     db_att = models.Attendance(user_id=user_id, lesson_id=att.lesson_id, similarity=att.similarity)
-    db.add(db_att); db.commit(); db.refresh(db_att)
+    db.add(db_att); await db.commit(); await db.refresh(db_att)
     return db_att
 
-def get_attendance(db: Session):
-    return db.query(models.Attendance).all()
+async def get_attendance(db: AsyncSession):
+    return (await db.scalars(select(models.Attendance))).all()
 
 
 # Lesson CRUD Operations
 
-def create_lesson(db: Session, lesson: schemas.LessonCreate, teacher_id: int) -> models.Lesson:
+# Relationships serialized by schemas.LessonRead, loaded up front to avoid N+1 lazy loads
+# (and because AsyncSession cannot lazy load at all)
+_LESSON_READ_LOADERS = (
+    selectinload(models.Lesson.files),
+    selectinload(models.Lesson.enrollments).joinedload(models.StudentLessonEnrollment.student),
+)
+
+async def create_lesson(db: AsyncSession, lesson: schemas.LessonCreate, teacher_id: int) -> models.Lesson:
     db_lesson = models.Lesson(**lesson.model_dump(), teacher_id=teacher_id)
     db.add(db_lesson)
-    db.commit()
-    db.refresh(db_lesson)
+    await db.commit()
+    await db.refresh(db_lesson, attribute_names=["created_at", "files", "enrollments"])
     return db_lesson
 
-def get_lesson(db: Session, lesson_id: int) -> models.Lesson | None:
-    return db.query(models.Lesson).filter(models.Lesson.id == lesson_id).first()
-
-def get_lessons_by_teacher(db: Session, teacher_id: int, skip: int = 0, limit: int = 100) -> list[models.Lesson]:
-    return db.query(models.Lesson).filter(models.Lesson.teacher_id == teacher_id).offset(skip).limit(limit).all()
-
-def get_lessons_for_student(db: Session, student_id: int, skip: int = 0, limit: int = 100) -> list[models.Lesson]:
-    return db.query(models.Lesson)\
+async def get_lesson(db: AsyncSession, lesson_id: int) -> models.Lesson | None:
+    """Lesson row only; use get_lesson_with_files_and_enrollments when relationships are needed."""
+    return await db.get(models.Lesson, lesson_id)
+
+async def get_lesson_with_files_and_enrollments(db: AsyncSession, lesson_id: int) -> models.Lesson | None:
+    """Lesson with files and enrollments (and their students) loaded in the same trip, ready for LessonRead."""
+    stmt = select(models.Lesson).options(*_LESSON_READ_LOADERS).where(models.Lesson.id == lesson_id)
+    return (await db.scalars(stmt)).one_or_none()
+
+async def get_lessons_by_teacher(db: AsyncSession, teacher_id: int, skip: int = 0, limit: int = 100) -> list[models.Lesson]:
+    stmt = select(models.Lesson)\
+        .options(*_LESSON_READ_LOADERS)\
+        .where(models.Lesson.teacher_id == teacher_id)\
+        .offset(skip).limit(limit)
+    return (await db.scalars(stmt)).all()
+
+async def get_lessons_for_student(db: AsyncSession, student_id: int, skip: int = 0, limit: int = 100) -> list[models.Lesson]:
+    stmt = select(models.Lesson)\
+        .options(*_LESSON_READ_LOADERS)\
         .join(models.StudentLessonEnrollment, models.StudentLessonEnrollment.lesson_id == models.Lesson.id)\
-        .filter(models.StudentLessonEnrollment.user_id == student_id)\
-        .offset(skip).limit(limit).all()
+        .where(models.StudentLessonEnrollment.user_id == student_id)\
+        .offset(skip).limit(limit)
+    return (await db.scalars(stmt)).all()
 
-def update_lesson(db: Session, lesson_id: int, lesson_update: schemas.LessonCreate) -> models.Lesson | None:
-    db_lesson = get_lesson(db, lesson_id)
+async def update_lesson(db: AsyncSession, lesson_id: int, lesson_update: schemas.LessonCreate) -> models.Lesson | None:
+    db_lesson = await get_lesson_with_files_and_enrollments(db, lesson_id)
     if db_lesson:
         db_lesson.title = lesson_update.title
         db_lesson.description = lesson_update.description
-        db.commit()
-        db.refresh(db_lesson)
+        # No refresh needed: nothing is server-generated on update and commit doesn't expire
+        await db.commit()
     return db_lesson
 
-def delete_lesson(db: Session, lesson_id: int) -> models.Lesson | None:
-    db_lesson = get_lesson(db, lesson_id)
+async def delete_lesson(db: AsyncSession, lesson_id: int) -> models.Lesson | None:
+    # Collections loaded up front so the delete-orphan cascade doesn't lazy load them
+    db_lesson = await get_lesson_with_files_and_enrollments(db, lesson_id)
     if db_lesson:
-        db.delete(db_lesson)
-        db.commit()
+        await db.delete(db_lesson)
+        await db.commit()
     return db_lesson
 
 # LessonFile CRUD Operations
 
-def create_lesson_file(db: Session, file_name: str, file_path: str, lesson_id: int) -> models.LessonFile:
+async def create_lesson_file(db: AsyncSession, file_name: str, file_path: str, lesson_id: int) -> models.LessonFile:
     db_lesson_file = models.LessonFile(filename=file_name, file_path=file_path, lesson_id=lesson_id)
     db.add(db_lesson_file)
-    db.commit()
-    db.refresh(db_lesson_file)
+    await db.commit()
+    await db.refresh(db_lesson_file)
     return db_lesson_file
 
-def get_lesson_files(db: Session, lesson_id: int) -> list[models.LessonFile]:
-    return db.query(models.LessonFile).filter(models.LessonFile.lesson_id == lesson_id).all()
-
-def get_lesson_file(db: Session, file_id: int) -> models.LessonFile | None:
-    return db.query(models.LessonFile).filter(models.LessonFile.id == file_id).first()
-
-def delete_lesson_file(db: Session, file_id: int) -> models.LessonFile | None:
-    db_lesson_file = get_lesson_file(db, file_id)
+async def get_lesson_files(db: AsyncSession, lesson_id: int) -> list[models.LessonFile]:
+    return (await db.scalars(select(models.LessonFile).where(models.LessonFile.lesson_id == lesson_id))).all()
+
+async def get_lesson_file(db: AsyncSession, file_id: int) -> models.LessonFile | None:
+    return await db.get(models.LessonFile, file_id)
+
+async def get_file_with_authz(db: AsyncSession, file_id: int, user_id: int):
+    """
+    Loads a file together with what is needed to authorize access to it, in one query.
+    :return: Row (LessonFile, teacher_id of its lesson, whether user_id is enrolled in it), or None.
+    """
+    enrolled = exists().where(
+        models.StudentLessonEnrollment.user_id == user_id,
+        models.StudentLessonEnrollment.lesson_id == models.Lesson.id,
+    ).label("enrolled")
+    stmt = select(models.LessonFile, models.Lesson.teacher_id, enrolled)\
+        .join(models.Lesson, models.Lesson.id == models.LessonFile.lesson_id)\
+        .where(models.LessonFile.id == file_id)
+    return (await db.execute(stmt)).one_or_none()
+
+async def delete_lesson_file(db: AsyncSession, file_id: int) -> models.LessonFile | None:
+    db_lesson_file = await get_lesson_file(db, file_id)
     if db_lesson_file:
-        db.delete(db_lesson_file)
-        db.commit()
+        await db.delete(db_lesson_file)
+        await db.commit()
     return db_lesson_file
 
 # StudentLessonEnrollment CRUD Operations
 
-def enroll_student(db: Session, enrollment: schemas.StudentLessonEnrollmentCreate) -> models.StudentLessonEnrollment:
-    # Check if enrollment already exists
-    existing_enrollment = get_enrollment(db, student_id=enrollment.user_id, lesson_id=enrollment.lesson_id)
-    if existing_enrollment:
-        return existing_enrollment # Or raise an exception, depending on desired behavior
-    
-    db_enrollment = models.StudentLessonEnrollment(**enrollment.model_dump())
-    db.add(db_enrollment)
-    db.commit()
-    db.refresh(db_enrollment)
-    return db_enrollment
-
-def unenroll_student(db: Session, student_id: int, lesson_id: int) -> models.StudentLessonEnrollment | None:
-    db_enrollment = get_enrollment(db, student_id, lesson_id)
+async def enroll_student(db: AsyncSession, enrollment: schemas.StudentLessonEnrollmentCreate) -> tuple[models.StudentLessonEnrollment | None, bool]:
+    """
+    Enrolls a student with a single round-trip upsert: INSERT ... ON CONFLICT DO NOTHING RETURNING the new row.
+    :return: (new enrollment, True), or (None, False) if the student was already enrolled.
+    """
+    stmt = _insert_ignore(db, models.StudentLessonEnrollment)\
+        .values(**enrollment.model_dump())\
+        .returning(models.StudentLessonEnrollment)
+    db_enrollment = (await db.execute(stmt)).scalar_one_or_none()
+    await db.commit()
+    if db_enrollment is None:
+        return None, False
+    # Relationships serialized by schemas.StudentLessonEnrollmentRead
+    await db.refresh(db_enrollment, attribute_names=["student", "lesson"])
+    return db_enrollment, True
+
+async def bulk_enroll_students(db: AsyncSession, lesson_id: int, user_ids: list[int]) -> None:
+    """Enrolls many students in one executemany INSERT; already-enrolled students are skipped."""
+    if not user_ids:
+        return
+    await db.execute(_insert_ignore(db, models.StudentLessonEnrollment), [
+        {"user_id": user_id, "lesson_id": lesson_id} for user_id in set(user_ids)
+    ])
+    await db.commit()
+
+async def unenroll_student(db: AsyncSession, student_id: int, lesson_id: int) -> models.StudentLessonEnrollment | None:
+    db_enrollment = await get_enrollment(db, student_id, lesson_id)
     if db_enrollment:
-        db.delete(db_enrollment)
-        db.commit()
+        await db.delete(db_enrollment)
+        await db.commit()
     return db_enrollment
 
-def get_enrollments_for_lesson(db: Session, lesson_id: int) -> list[models.StudentLessonEnrollment]:
-    return db.query(models.StudentLessonEnrollment).filter(models.StudentLessonEnrollment.lesson_id == lesson_id).all()
+async def get_enrollments_for_lesson(db: AsyncSession, lesson_id: int) -> list[models.StudentLessonEnrollment]:
+    stmt = select(models.StudentLessonEnrollment).where(models.StudentLessonEnrollment.lesson_id == lesson_id)
+    return (await db.scalars(stmt)).all()
 
-def get_enrollment(db: Session, student_id: int, lesson_id: int) -> models.StudentLessonEnrollment | None:
-    return db.query(models.StudentLessonEnrollment)\
-        .filter(models.StudentLessonEnrollment.user_id == student_id, models.StudentLessonEnrollment.lesson_id == lesson_id)\
-        .first()
\ No newline at end of file
+async def get_enrollment(db: AsyncSession, student_id: int, lesson_id: int) -> models.StudentLessonEnrollment | None:
+    return await db.get(models.StudentLessonEnrollment, (student_id, lesson_id))
\ No newline at end of file
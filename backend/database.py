@@ -1,14 +1,20 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 
+# Async drivers for the sync URLs used in .env (sqlite:///..., postgresql://...)
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
 load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+DATABASE_URL = make_url(os.getenv("DATABASE_URL"))
+if DATABASE_URL.drivername in ASYNC_DRIVERS:
+    DATABASE_URL = DATABASE_URL.set(drivername=ASYNC_DRIVERS[DATABASE_URL.drivername])
+if DATABASE_URL.get_backend_name() == "sqlite":
+    engine = create_async_engine(DATABASE_URL)
 else:
-    engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+    engine = create_async_engine(DATABASE_URL, pool_size=20, max_overflow=0)
+# expire_on_commit=False: objects stay readable after commit without an implicit (async) reload
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+Base = declarative_base()
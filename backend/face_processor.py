@@ -1,76 +1,192 @@
 import os
+import threading
 import cv2
 import numpy as np
-import dlib
-from ultralytics import YOLO # Corrected import based on standard usage
 import onnxruntime
 
+try:
+    # Only needed for the 68-point landmark fallback (detector without keypoints, no 5-point model)
+    import dlib
+except ImportError:
+    dlib = None
+
+try:
+    # libjpeg-turbo's SIMD decoder; optional, cv2.imdecode is used when unavailable
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _turbo_jpeg = None
+
+try:
+    # Optional JIT for the embedding normalization kernel; NumPy is used when unavailable
+    from numba import njit
+except ImportError:
+    njit = None
+
 # Define constants for model paths and alignment parameters
-YOLO_MODEL_PATH = "backend/ml_models/yolov11n-face.pt"
+# The YOLO detector is exported to ONNX once by backend/prepare_models.py, so the
+# Ultralytics/PyTorch runtime is not needed to serve requests.
+YOLO_MODEL_PATH = "backend/ml_models/yolov11n-face.onnx"
 DLIB_PREDICTOR_PATH = "backend/ml_models/shape_predictor_68_face_landmarks.dat"
 ARCFACE_MODEL_PATH = "backend/ml_models/arcface_model.onnx"
+# INT8 (QDQ) ArcFace produced by backend/prepare_models.py; preferred over FP32 when present
+ARCFACE_INT8_MODEL_PATH = "backend/ml_models/arcface_int8.onnx"
+# Output name of ArcFace graphs with LpNormalization appended by backend/prepare_models.py
+ARCFACE_NORMALIZED_OUTPUT = "embedding_l2"
+# Optional 5-point landmark model used instead of dlib when present. Input is a batch of
+# face crops (N, 3, 112, 112), BGR, normalized like ArcFace input; output is (N, 10) with
+# (x, y) of left eye, right eye, nose, left and right mouth corners, relative to the crop (0..1).
+LANDMARK_MODEL_PATH = "backend/ml_models/landmarks_5pt.onnx"
+LANDMARK_INPUT_SIZE = (112, 112)
 
 OUTPUT_SIZE = (112, 112) # For aligned faces, typical for ArcFace
 DETECTION_CONFIDENCE = 0.6
 MIN_FACE_SIZE = 32
+YOLO_INPUT_SIZE = 640 # Fixed (batch=1) input size of the exported detector
+YOLO_NUM_KEYPOINTS = 5 # Eyes, nose tip and mouth corners, emitted by keypoint-enabled face detectors
+YOLO_KEYPOINT_CHANNELS = 5 + YOLO_NUM_KEYPOINTS * 3 # Box, score and (x, y, visibility) per keypoint
+NMS_IOU_THRESHOLD = 0.45
+LETTERBOX_FILL = 114 # Padding value used by Ultralytics during training
+JPEG_MAGIC = b'\xff\xd8\xff'
+MAX_IMAGE_SIDE = 1280 # Uploads are processed at most at this resolution (longest side)
+MAX_EMBEDDING_BATCH = 32 # Max faces per ArcFace run; also sizes the aligned-face scratch buffer
+EMBEDDING_DIMENSION = 512
 
-# Initialize models globally
+# Models are loaded lazily on first use (see _ensure_loaded), once per process. Under a
+# prefork server (e.g. gunicorn --preload) call load_models() in the master instead, so
+# workers inherit them copy-on-write.
 yolo_detector = None
 dlib_predictor = None
 arcface_session = None
+landmark_session = None
+_models_loaded = False
+_intra_op_threads = None # As passed to load_models, for the lazily loaded landmark model
+_models_lock = threading.Lock()
+
+# Per-thread scratch buffers (letterbox canvas, YOLO input, aligned faces) and ArcFace IOBinding
+_thread_state = threading.local()
 
-def load_models():
-    global yolo_detector, dlib_predictor, arcface_session
+def load_models(intra_op_threads=None):
+    """
+    Loads the detector and ArcFace models into this process, plus the landmark model when the
+    detector is known not to output keypoints (otherwise it is loaded on first need, if ever).
+    :param intra_op_threads: ORT threads per session; defaults to the number of physical cores.
+    """
+    global yolo_detector, arcface_session, _intra_op_threads
     if not os.path.exists(YOLO_MODEL_PATH):
         # This is a critical error, should stop the application or indicate severe degradation
         print(f"CRITICAL ERROR: YOLO model not found at {YOLO_MODEL_PATH}")
         raise FileNotFoundError(f"YOLO model not found at {YOLO_MODEL_PATH}")
-    if not os.path.exists(DLIB_PREDICTOR_PATH):
-        print(f"CRITICAL ERROR: Dlib predictor not found at {DLIB_PREDICTOR_PATH}")
-        raise FileNotFoundError(f"Dlib predictor not found at {DLIB_PREDICTOR_PATH}")
     if not os.path.exists(ARCFACE_MODEL_PATH):
         print(f"CRITICAL ERROR: ArcFace model not found at {ARCFACE_MODEL_PATH}")
         raise FileNotFoundError(f"ArcFace model not found at {ARCFACE_MODEL_PATH}")
 
     try:
-        yolo_detector = YOLO(YOLO_MODEL_PATH)
-        dlib_predictor = dlib.shape_predictor(DLIB_PREDICTOR_PATH)
-        # Consider providers carefully for ONNX Runtime, e.g., ['CPUExecutionProvider']
-        arcface_session = onnxruntime.InferenceSession(ARCFACE_MODEL_PATH, providers=['CPUExecutionProvider'])
-        print("Face processing models loaded successfully.")
+        yolo_detector = _create_session(YOLO_MODEL_PATH, intra_op_threads)
+        if os.path.exists(ARCFACE_INT8_MODEL_PATH):
+            arcface_session = _create_session(ARCFACE_INT8_MODEL_PATH, intra_op_threads)
+        else:
+            arcface_session = _create_session(ARCFACE_MODEL_PATH, intra_op_threads)
     except Exception as e:
         print(f"CRITICAL ERROR: Failed to load one or more ML models: {e}")
         # Depending on application design, might want to re-raise or exit
         raise RuntimeError(f"Failed to load ML models: {e}")
+    _intra_op_threads = intra_op_threads
+    channels = yolo_detector.get_outputs()[0].shape[1]
+    if isinstance(channels, int) and channels != YOLO_KEYPOINT_CHANNELS:
+        _load_landmark_models() # Every face will need it; fail now rather than on the first request
+    print("Face processing models loaded successfully.")
+    global _models_loaded
+    _models_loaded = True
 
 
-def align_single_face(image_rgb, rect_coords, predictor, output_size=OUTPUT_SIZE):
+def _load_landmark_models():
     """
-    Aligns a single face found in an image.
-    :param image_rgb: NumPy array of the input image (RGB).
-    :param rect_coords: Tuple (x1, y1, x2, y2) for the detected face.
-    :param predictor: dlib shape predictor object.
-    :param output_size: Tuple (width, height) for the output aligned face.
-    :return: NumPy array of the aligned face (RGB), or None if alignment fails.
+    Loads the landmark stage used for faces the detector gives no keypoints for: the 5-point
+    ONNX model when present, otherwise the dlib predictor.
     """
-    if predictor is None:
-        # This check should ideally be done before calling this function (e.g. in load_models)
-        # but as a safeguard:
-        print("ERROR: Dlib predictor not loaded in align_single_face.")
-        return None
+    global landmark_session, dlib_predictor
+    if landmark_session is not None or dlib_predictor is not None:
+        return
+    if os.path.exists(LANDMARK_MODEL_PATH):
+        landmark_session = _create_session(LANDMARK_MODEL_PATH, _intra_op_threads)
+    elif dlib is not None and os.path.exists(DLIB_PREDICTOR_PATH):
+        dlib_predictor = dlib.shape_predictor(DLIB_PREDICTOR_PATH)
+    else:
+        print(f"CRITICAL ERROR: Detector outputs no keypoints, and neither landmark model {LANDMARK_MODEL_PATH} "
+              f"nor Dlib predictor {DLIB_PREDICTOR_PATH} (with dlib installed) is available")
+        raise FileNotFoundError(f"Landmark model not found at {LANDMARK_MODEL_PATH}")
 
-    x1, y1, x2, y2 = rect_coords
-    rect = dlib.rectangle(x1, y1, x2, y2)
-    
-    shape = predictor(image_rgb, rect)
-    
-    # Estimate eye centers - points 36-41 are left eye, 42-47 are right eye
-    left_eye_pts = np.array([(shape.part(i).x, shape.part(i).y) for i in range(36, 42)])
-    right_eye_pts = np.array([(shape.part(i).x, shape.part(i).y) for i in range(42, 48)])
-    
-    left_eye_center = left_eye_pts.mean(axis=0).astype("int")
-    right_eye_center = right_eye_pts.mean(axis=0).astype("int")
-    
+
+def _ensure_landmarks_loaded():
+    """Loads the landmark stage on first need; double-checked like _ensure_loaded."""
+    if landmark_session is not None or dlib_predictor is not None:
+        return
+    with _models_lock:
+        _load_landmark_models()
+
+
+def _ensure_loaded():
+    """Loads the models on first use; double-checked so concurrent first requests load them once."""
+    if _models_loaded:
+        return
+    with _models_lock:
+        if not _models_loaded:
+            load_models()
+
+
+def init_worker(num_workers=1):
+    """
+    ProcessPoolExecutor initializer: loads the models once per worker process, giving each
+    worker an equal share of the physical cores. Failures are only logged so the pool stays
+    usable; the first call then re-raises them via _ensure_loaded.
+    :param num_workers: Number of worker processes in the pool.
+    """
+    try:
+        with _models_lock:
+            load_models(max(1, _physical_cores() // num_workers))
+    except Exception as e:
+        print(f"ERROR: Face worker could not preload models: {e}")
+
+
+def _physical_cores():
+    """Number of physical CPU cores (falls back to logical cores without psutil)."""
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+
+def _create_session(model_path, intra_op_threads=None):
+    """
+    Creates an ONNX Runtime CPU session with full graph optimizations, so quantized
+    graphs fuse into QLinearConv/MatMulInteger kernels. Intra-op threads are pinned to
+    physical cores (hyperthreads only thrash cache on these small convolutions) and
+    oneDNN is preferred when the installed ORT build ships it.
+    """
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.enable_cpu_mem_arena = True
+    sess_options.intra_op_num_threads = intra_op_threads or _physical_cores()
+    sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    # Don't busy-wait between runs; requests are bursty and cores are shared with the web workers
+    sess_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+    available = onnxruntime.get_available_providers()
+    providers = [p for p in ('DnnlExecutionProvider', 'CPUExecutionProvider') if p in available]
+    return onnxruntime.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+
+
+def align_face_from_eyes(image_bgr, left_eye_center, right_eye_center, output_size=OUTPUT_SIZE, dst=None):
+    """
+    Rotates, scales and crops a face so the eyes land at fixed positions in the output.
+    :param image_bgr: NumPy array of the input image (BGR).
+    :param left_eye_center: (x, y) of the left eye center in the input image.
+    :param right_eye_center: (x, y) of the right eye center in the input image.
+    :param output_size: Tuple (width, height) for the output aligned face.
+    :param dst: Optional preallocated (height, width, 3) uint8 array to warp into.
+    :return: NumPy array of the aligned face (BGR), or None if alignment fails.
+    """
     # Compute angle between the eye centers
     dy = right_eye_center[1] - left_eye_center[1]
     dx = right_eye_center[0] - left_eye_center[0]
@@ -92,146 +208,397 @@ def align_single_face(image_rgb, rect_coords, predictor, output_size=OUTPUT_SIZE
     scale = (desired_face_width * desired_eye_dist_prop) / eye_dist
     
     # Get the center of the eyes
-    eyes_center = ((left_eye_center[0] + right_eye_center[0]) // 2,
-                   (left_eye_center[1] + right_eye_center[1]) // 2)
-    
-    # Get rotation matrix
-    M = cv2.getRotationMatrix2D(eyes_center, angle, scale)
+    eyes_center = (float(left_eye_center[0] + right_eye_center[0]) / 2,
+                   float(left_eye_center[1] + right_eye_center[1]) / 2)
     
-    # Update translation part of the matrix
+    # Target position of the eyes center in the output
     tX = desired_face_width * 0.5
     tY = desired_face_height * desired_left_eye_x_prop # Shift based on desired left eye y position
     
-    M[0, 2] += (tX - eyes_center[0])
-    M[1, 2] += (tY - eyes_center[1])
+    # Rotation + scale about eyes_center, translated so eyes_center lands on (tX, tY).
+    # Same matrix as cv2.getRotationMatrix2D plus the translation fix-up, built directly.
+    c = np.cos(np.radians(angle)) * scale
+    s = np.sin(np.radians(angle)) * scale
+    M = np.array([[c, s, tX - (c * eyes_center[0] + s * eyes_center[1])],
+                  [-s, c, tY - (-s * eyes_center[0] + c * eyes_center[1])]])
     
     # Apply affine transformation
-    aligned_face = cv2.warpAffine(image_rgb, M, (desired_face_width, desired_face_height), flags=cv2.INTER_CUBIC)
+    aligned_face = cv2.warpAffine(image_bgr, M, (desired_face_width, desired_face_height), dst=dst, flags=cv2.INTER_CUBIC)
     
-    return aligned_face # RGB image
+    return aligned_face # BGR image
+
+
+def align_single_face(image_bgr, rect_coords, predictor, output_size=OUTPUT_SIZE, dst=None, kps=None):
+    """
+    Aligns a single face found in an image. Uses the detector's keypoints when given,
+    otherwise dlib's 68-point landmarks (fallback for when the 5-point landmark model
+    is not available).
+    :param image_bgr: NumPy array of the input image (BGR).
+    :param rect_coords: Tuple (x1, y1, x2, y2) for the detected face.
+    :param predictor: dlib shape predictor object.
+    :param output_size: Tuple (width, height) for the output aligned face.
+    :param dst: Optional preallocated (height, width, 3) uint8 array to warp into.
+    :param kps: Optional (5, 2) keypoints from the detector (left eye, right eye, nose, mouth corners).
+    :return: NumPy array of the aligned face (BGR), or None if alignment fails.
+    """
+    if kps is not None:
+        # The detector already located the eyes, no need for the (GIL-bound) dlib pass
+        return align_face_from_eyes(image_bgr, kps[0], kps[1], output_size, dst=dst)
+
+    if predictor is None:
+        # This check should ideally be done before calling this function (e.g. in load_models)
+        # but as a safeguard:
+        print("ERROR: Dlib predictor not loaded in align_single_face.")
+        return None
+
+    x1, y1, x2, y2 = rect_coords
+    rect = dlib.rectangle(x1, y1, x2, y2)
+    
+    shape = predictor(image_bgr, rect)
+    
+    # Convert all 68 parts to a (68, 2) array once, then estimate both eye centers with
+    # a single mean - points 36-41 are left eye, 42-47 are right eye
+    landmarks = np.array([(p.x, p.y) for p in shape.parts()], dtype=np.float32)
+    left_eye_center, right_eye_center = landmarks[36:48].reshape(2, 6, 2).mean(axis=1)
+    
+    return align_face_from_eyes(image_bgr, left_eye_center, right_eye_center, output_size, dst=dst)
+
 
+def detect_landmarks(image_bgr, face_rects, session=None):
+    """
+    Predicts 5-point landmarks for all detected faces in one batched ORT run.
+    :param image_bgr: NumPy array of the input image (BGR).
+    :param face_rects: List of face rectangles [(x1, y1, x2, y2), ...].
+    :param session: ONNX Runtime session of the 5-point landmark model.
+    :return: NumPy array of landmarks in image coordinates, shape (N, 5, 2).
+    """
+    if session is None:
+        _ensure_loaded()
+    current_landmark_session = session if session is not None else landmark_session
+    if current_landmark_session is None:
+        print("ERROR: Landmark model not loaded in detect_landmarks.")
+        return np.empty((0, 5, 2), dtype=np.float32)
+
+    crops = [image_bgr[y1:y2, x1:x2] for x1, y1, x2, y2 in face_rects]
+    # Resize + normalize + HWC->NCHW for every crop in one pass
+    input_blob = cv2.dnn.blobFromImages(crops, scalefactor=1.0 / 128.0, size=LANDMARK_INPUT_SIZE,
+                                        mean=(127.5, 127.5, 127.5), swapRB=False)
+
+    input_name = current_landmark_session.get_inputs()[0].name
+    landmarks = current_landmark_session.run(None, {input_name: input_blob})[0].reshape(-1, 5, 2)
+
+    # Map crop-relative coordinates back into the full image
+    rects = np.asarray(face_rects, dtype=np.float32)
+    sizes = (rects[:, 2:4] - rects[:, 0:2])[:, None, :]
+    return landmarks * sizes + rects[:, None, 0:2]
 
-def detect_faces(image_rgb, yolo=None, confidence_threshold=DETECTION_CONFIDENCE, min_face_size=MIN_FACE_SIZE):
+
+def _letterbox(image_bgr, size=YOLO_INPUT_SIZE):
+    """
+    Resizes an image to fit a size x size square, keeping aspect ratio and padding the rest.
+    Writes into this thread's reusable canvas, so the result is only valid until the next call.
+    :return: Tuple (letterboxed image, scale ratio, x padding, y padding).
     """
-    Detects faces in an image using YOLO.
-    :param image_rgb: NumPy array of the input image (RGB).
-    :param yolo: YOLO detector object.
+    h, w = image_bgr.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+
+    canvas = _thread_buffer('letterbox', (size, size, 3), np.uint8)
+    # Only the padding strips need filling; the resized image overwrites the rest
+    canvas[:pad_y] = LETTERBOX_FILL
+    canvas[pad_y + new_h:] = LETTERBOX_FILL
+    canvas[:, :pad_x] = LETTERBOX_FILL
+    canvas[:, pad_x + new_w:] = LETTERBOX_FILL
+
+    roi = canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w]
+    if (new_w, new_h) != (w, h):
+        cv2.resize(image_bgr, (new_w, new_h), dst=roi, interpolation=cv2.INTER_LINEAR)
+    else:
+        roi[...] = image_bgr
+    return canvas, ratio, pad_x, pad_y
+
+
+def detect_faces(image_bgr, yolo=None, confidence_threshold=DETECTION_CONFIDENCE, min_face_size=MIN_FACE_SIZE):
+    """
+    Detects faces in an image using the ONNX-exported YOLO model.
+    :param image_bgr: NumPy array of the input image (BGR).
+    :param yolo: ONNX Runtime session of the YOLO detector.
     :param confidence_threshold: Minimum confidence for a detection to be considered.
     :param min_face_size: Minimum size (width or height) for a detected face.
-    :return: List of face rectangles [(x1, y1, x2, y2), ...].
+    :return: List of (rect, kps) tuples, where rect is (x1, y1, x2, y2) and kps is a (5, 2)
+             array of keypoints in image coordinates, or None if the model doesn't predict them.
     """
     # Use global yolo_detector if yolo parameter is None
+    if yolo is None:
+        _ensure_loaded()
     current_yolo_detector = yolo if yolo is not None else yolo_detector
     if current_yolo_detector is None:
         print("ERROR: YOLO model not loaded in detect_faces.")
         # Depending on strictness, could raise ValueError or return empty list
         return [] 
 
-    results = current_yolo_detector(image_rgb, verbose=False)[0] # Assuming results[0] contains detections
+    # Preprocess once: letterbox to 640x640, BGR->RGB, HWC->NCHW, scale to [0, 1]
+    canvas, ratio, pad_x, pad_y = _letterbox(image_bgr)
+    input_blob = _thread_buffer('yolo_input', (1, 3, YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), np.float32)
+    np.multiply(canvas[..., ::-1].transpose((2, 0, 1)), np.float32(1.0 / 255.0), out=input_blob[0])
+
+    input_name = current_yolo_detector.get_inputs()[0].name
+    # Raw output is (1, 4 + num_classes, num_anchors): cx, cy, w, h, then class scores.
+    # Keypoint (pose) variants append 5 x (x, y, visibility) after the single face score.
+    predictions = current_yolo_detector.run(None, {input_name: input_blob})[0][0].T
+
+    scores = predictions[:, 4]
+    keep = scores >= confidence_threshold
+    if not np.any(keep):
+        return []
+    predictions, scores = predictions[keep], scores[keep]
+
+    # Convert center boxes to top-left (x, y, w, h) for NMS
+    boxes = predictions[:, :4].copy()
+    boxes[:, 0] -= boxes[:, 2] / 2
+    boxes[:, 1] -= boxes[:, 3] / 2
+    indices = cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(), confidence_threshold, NMS_IOU_THRESHOLD)
+
+    keypoints = None
+    if predictions.shape[1] == YOLO_KEYPOINT_CHANNELS:
+        keypoints = predictions[:, 5:].reshape(-1, YOLO_NUM_KEYPOINTS, 3)[:, :, :2]
+
+    h, w = image_bgr.shape[:2]
     detected_faces = []
-    for box in results.boxes:
-        conf = box.conf.item()
-        if conf < confidence_threshold:
-            continue
-        x1, y1, x2, y2 = map(int, box.xyxy[0])
+    for i in np.array(indices).flatten():
+        bx, by, bw, bh = boxes[i]
+        # Undo letterbox padding and scaling to get coordinates in the original image
+        x1 = int(max(0, (bx - pad_x) / ratio))
+        y1 = int(max(0, (by - pad_y) / ratio))
+        x2 = int(min(w, (bx + bw - pad_x) / ratio))
+        y2 = int(min(h, (by + bh - pad_y) / ratio))
         if (x2 - x1) < min_face_size or (y2 - y1) < min_face_size:
             continue
-        detected_faces.append((x1, y1, x2, y2))
+        kps = None
+        if keypoints is not None:
+            kps = (keypoints[i] - (pad_x, pad_y)) / ratio
+        detected_faces.append(((x1, y1, x2, y2), kps))
     return detected_faces
 
 
-def get_embedding_from_aligned_face(aligned_face_rgb, session=None):
+def _thread_buffer(name, shape, dtype):
+    """Returns a scratch array owned by the calling thread, allocated on first use."""
+    buffer = getattr(_thread_state, name, None)
+    if buffer is None:
+        buffer = np.empty(shape, dtype=dtype)
+        setattr(_thread_state, name, buffer)
+    return buffer
+
+
+def _aligned_face_buffer(num_faces):
+    """Scratch (N, 112, 112, 3) array that aligned faces are warped into."""
+    shape = OUTPUT_SIZE[::-1] + (3,)
+    if num_faces > MAX_EMBEDDING_BATCH:
+        return np.empty((num_faces,) + shape, dtype=np.uint8)
+    return _thread_buffer('aligned_faces', (MAX_EMBEDDING_BATCH,) + shape, np.uint8)
+
+
+def _get_arcface_binding(session):
+    """
+    Returns this thread's IOBinding for the session, creating it on first use.
+    IOBinding objects are not thread-safe, hence one per thread.
     """
-    Extracts ArcFace embedding from an aligned face image.
-    :param aligned_face_rgb: NumPy array of the aligned face (112x112 RGB).
+    binding = getattr(_thread_state, 'arcface_binding', None)
+    if binding is None or binding[0] is not session:
+        binding = (session, session.io_binding())
+        _thread_state.arcface_binding = binding
+    return binding[1]
+
+
+def _run_arcface(session, input_batch, output_batch):
+    """Runs ArcFace in place: reads input_batch and writes output_batch via IOBinding, no copies."""
+    io_binding = _get_arcface_binding(session)
+    io_binding.bind_input(session.get_inputs()[0].name, 'cpu', 0, np.float32,
+                          list(input_batch.shape), input_batch.ctypes.data)
+    io_binding.bind_output(session.get_outputs()[0].name, 'cpu', 0, np.float32,
+                           list(output_batch.shape), output_batch.ctypes.data)
+    session.run_with_iobinding(io_binding)
+
+
+def get_embeddings_from_aligned_faces(aligned_faces_bgr, session=None):
+    """
+    Extracts ArcFace embeddings for a batch of aligned face images in a single ORT run.
+    :param aligned_faces_bgr: List of NumPy arrays of aligned faces (112x112 BGR).
     :param session: ONNX Runtime session for ArcFace model.
-    :return: NumPy array (embedding vector).
+    :return: NumPy array of L2-normalized embeddings, shape (N, embedding_dim).
     """
+    if session is None:
+        _ensure_loaded()
     current_arcface_session = session if session is not None else arcface_session
     if current_arcface_session is None:
-        print("ERROR: ArcFace model not loaded in get_embedding_from_aligned_face.")
+        print("ERROR: ArcFace model not loaded in get_embeddings_from_aligned_faces.")
         # Depending on strictness, could raise ValueError or return None/empty array
         return np.array([])
 
-    # Preprocessing specific to ArcFace model
-    img = cv2.cvtColor(aligned_face_rgb, cv2.COLOR_RGB2BGR) # ArcFace often expects BGR
-    img = (img.astype(np.float32) - 127.5) / 128.0
-    img = img.transpose((2, 0, 1)) # HWC to CHW (112, 112, 3) -> (3, 112, 112)
-    input_blob = np.expand_dims(img, axis=0) # Add batch dimension (1, 3, 112, 112)
+    # Preprocessing specific to ArcFace model (input is already BGR, as ArcFace expects):
+    # mean-subtract, scale and HWC->NCHW for the whole batch in a single SIMD pass
+    input_blob = cv2.dnn.blobFromImages(aligned_faces_bgr, scalefactor=1.0 / 128.0, size=OUTPUT_SIZE,
+                                        mean=(127.5, 127.5, 127.5), swapRB=False)
 
-    input_name = current_arcface_session.get_inputs()[0].name
-    output_name = current_arcface_session.get_outputs()[0].name
-    
-    embedding = current_arcface_session.run([output_name], {input_name: input_blob})[0]
-    embedding = embedding.flatten() # Ensure it's a 1D vector
-    
-    # Normalize the embedding (L2 normalization)
-    norm = np.linalg.norm(embedding)
-    if norm == 0: 
+    output_dim = current_arcface_session.get_outputs()[0].shape[-1]
+    if not isinstance(output_dim, int):
+        output_dim = EMBEDDING_DIMENSION
+    # ORT writes straight into this array through the IOBinding
+    embeddings = np.empty((len(input_blob), output_dim), dtype=np.float32)
+
+    if current_arcface_session.get_inputs()[0].shape[0] == 1:
+        # Model was exported with a fixed batch of 1 (see prepare_models.make_arcface_batch_dynamic)
+        for i in range(len(input_blob)):
+            _run_arcface(current_arcface_session, input_blob[i:i + 1], embeddings[i:i + 1])
+    else:
+        for start in range(0, len(input_blob), MAX_EMBEDDING_BATCH):
+            end = start + MAX_EMBEDDING_BATCH
+            _run_arcface(current_arcface_session, input_blob[start:end], embeddings[start:end])
+
+    if current_arcface_session.get_outputs()[0].name == ARCFACE_NORMALIZED_OUTPUT:
+        return embeddings # Already L2-normalized inside the graph
+
+    # Model not yet prepared: normalize the embeddings (L2 normalization) for the whole batch at once
+    if l2_normalize_rows(embeddings):
         # This case might indicate an issue or a zero vector, handle as appropriate
         print("Warning: Zero norm for embedding.")
-        return embedding 
-    embedding = embedding / norm
-    return embedding
+    return embeddings
+
+
+def _l2_normalize_rows_numpy(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    zero_rows = norms == 0
+    norms[zero_rows] = 1.0
+    vectors /= norms
+    return int(np.count_nonzero(zero_rows))
+
+
+if njit is not None:
+    # Single fused pass per row (sum of squares, then scale) that LLVM vectorizes to SIMD
+    # FMAs; no temporaries, unlike the NumPy version. Not parallel: batches are at most
+    # MAX_EMBEDDING_BATCH rows, too small to amortize spinning up threads.
+    @njit(cache=True, fastmath=True)
+    def _l2_normalize_rows_jit(vectors):
+        zero_rows = 0
+        for i in range(vectors.shape[0]):
+            sum_sq = 0.0
+            for k in range(vectors.shape[1]):
+                sum_sq += vectors[i, k] * vectors[i, k]
+            if sum_sq == 0.0:
+                zero_rows += 1
+                continue
+            inv_norm = 1.0 / np.sqrt(sum_sq)
+            for k in range(vectors.shape[1]):
+                vectors[i, k] *= inv_norm
+        return zero_rows
 
 
-def get_face_embeddings_from_image_bytes(image_bytes: bytes) -> list[np.ndarray]:
+def l2_normalize_rows(vectors):
     """
-    Main function to process an image from bytes, detect faces, align them, and extract embeddings.
-    :param image_bytes: Bytes of the input image.
-    :return: List of NumPy arrays (embeddings), or empty list if errors or no faces.
+    L2-normalizes each row of a float32 (N, D) array in place; zero rows are left as they are.
+    :param vectors: C-contiguous float32 NumPy array of shape (N, D).
+    :return: Number of zero rows.
     """
-    # Ensure models are loaded (this is critical)
-    if yolo_detector is None or dlib_predictor is None or arcface_session is None:
-        print("ERROR: Models not loaded. Call load_models() before processing.")
-        # Depending on design, could try to call load_models() here, but it's better if App calls it explicitly at startup.
-        # For this subtask, we'll assume they are loaded by the module-level call or an explicit app init.
-        # If not, this function will fail when sub-functions try to access None models.
-        # Returning empty list for now if models aren't loaded.
-        return []
+    if njit is not None:
+        return _l2_normalize_rows_jit(vectors)
+    return _l2_normalize_rows_numpy(vectors)
+
+
+def _jpeg_scaling_factor(width, height, max_side):
+    """Largest libjpeg-turbo DCT downscale (1/8, 1/4, 1/2) that keeps the longest side >= max_side."""
+    for denominator in (8, 4, 2):
+        if max(width, height) // denominator >= max_side:
+            return (1, denominator)
+    return None
+
 
-    # 1. Decode image_bytes to OpenCV image (RGB)
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+def decode_image(image_bytes, max_side=MAX_IMAGE_SIDE):
+    """
+    Decodes image bytes to a BGR NumPy array whose longest side is at most max_side.
+    Large JPEGs are downscaled during decoding by libjpeg-turbo when available, which skips
+    most of the IDCT work; anything still too large is resized with INTER_AREA.
+    :return: NumPy array (BGR) or None if the bytes cannot be decoded.
+    """
+    img_bgr = None
+    if _turbo_jpeg is not None and image_bytes[:3] == JPEG_MAGIC:
+        try:
+            width, height, _, _ = _turbo_jpeg.decode_header(image_bytes)
+            img_bgr = _turbo_jpeg.decode(image_bytes, pixel_format=TJPF_BGR,
+                                         scaling_factor=_jpeg_scaling_factor(width, height, max_side))
+        except OSError:
+            pass # Corrupt or unusual JPEG: let OpenCV have a go
     if img_bgr is None:
-        print("Warning: Could not decode image from bytes.")
-        return []
-    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+        img_bgr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if img_bgr is None:
+            return None
 
-    # 2. Detect faces
+    h, w = img_bgr.shape[:2]
+    scale = max_side / max(h, w)
+    if scale < 1.0:
+        img_bgr = cv2.resize(img_bgr, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img_bgr
+
+
+def _locate_faces(img_bgr):
+    """
+    Detects faces and the eye keypoints used to align them.
+    Keypoint-enabled detectors give the eye positions directly; otherwise the landmark stage is
+    loaded on first need, landmarks for all faces are predicted in one batch when the landmark
+    model is available, and dlib (inside align_single_face) is the last resort, signalled by a
+    None entry.
+    :return: Tuple of (list of (x1, y1, x2, y2) face rectangles, list of keypoints or None).
+    """
     # Pass the globally loaded models explicitly to ensure clarity and testability,
     # or rely on them being available in the global scope of the sub-functions.
-    face_rects = detect_faces(img_rgb, yolo=yolo_detector)
-    if not face_rects:
-        # print("No faces detected in the image.") # This can be noisy if called often
-        return []
+    detections = detect_faces(img_bgr, yolo=yolo_detector)
+    face_rects = [rect for rect, _ in detections]
+    face_kps = [kps for _, kps in detections]
+    if any(kps is None for kps in face_kps):
+        _ensure_landmarks_loaded()
+    if landmark_session is not None and any(kps is None for kps in face_kps):
+        missing = [i for i, kps in enumerate(face_kps) if kps is None]
+        landmarks = detect_landmarks(img_bgr, [face_rects[i] for i in missing], session=landmark_session)
+        for i, points in zip(missing, landmarks):
+            face_kps[i] = points
+    return face_rects, face_kps
 
-    embeddings = []
-    for rect in face_rects:
-        # 3. Align each face
-        aligned_face = align_single_face(img_rgb, rect, predictor=dlib_predictor)
-        if aligned_face is None:
-            # print(f"Warning: Failed to align face at rect {rect}.")
-            continue # Skip if alignment fails
-
-        # 4. Get embedding for each aligned face
-        embedding = get_embedding_from_aligned_face(aligned_face, session=arcface_session)
-        if embedding.size == 0: # Check if embedding extraction failed
-            # print(f"Warning: Failed to get embedding for aligned face from rect {rect}.")
-            continue
-        embeddings.append(embedding)
-    
-    return embeddings
 
-# Call load_models() at module level to ensure models are loaded on import.
-# This might impact server startup time and behavior in some deployment scenarios (e.g. multiple workers).
-# An explicit initialization function called by the main app is often preferred for more control.
-try:
-    load_models()
-except Exception as e:
-    # Log the error prominently. The application might not be able to start or function correctly.
-    print(f"FATAL: Failed to initialize face_processor module due to model loading errors: {e}")
-    # Depending on the application's error handling strategy, this might re-raise,
-    # or the functions above will fail if models are None.
-    # For now, the functions above have checks for None models.
-    pass
\ No newline at end of file
+def align_faces_from_image_bytes(image_bytes: bytes | bytearray) -> np.ndarray:
+    """
+    First stage of embedding an upload, run for each request on its own: decodes the image,
+    detects the faces and aligns them for ArcFace.
+    :param image_bytes: Bytes (or a bytearray) of the input image.
+    :return: (N, 112, 112, 3) uint8 array of aligned faces (BGR); N is 0 if the image could not
+             be decoded or contains no faces.
+    """
+    _ensure_loaded()
+
+    img_bgr = decode_image(image_bytes)
+    if img_bgr is None:
+        print("Warning: Could not decode image from bytes.")
+        return np.empty((0,) + OUTPUT_SIZE[::-1] + (3,), dtype=np.uint8)
+
+    face_rects, face_kps = _locate_faces(img_bgr)
+    aligned_faces = _aligned_face_buffer(len(face_rects))
+    num_aligned = 0
+    for rect, kps in zip(face_rects, face_kps):
+        aligned_face = align_single_face(img_bgr, rect, predictor=dlib_predictor,
+                                         dst=aligned_faces[num_aligned], kps=kps)
+        if aligned_face is not None: # Skip if alignment fails
+            num_aligned += 1
+    return aligned_faces[:num_aligned].copy() # The scratch buffer is reused by the next call
+
+
+def embed_aligned_faces(face_batches: list) -> list[list[np.ndarray]]:
+    """
+    Second stage, run for several requests at once: embeds the aligned faces of all of them in
+    as few ArcFace runs as possible instead of one small run per request.
+    :param face_batches: List of (N, 112, 112, 3) arrays from align_faces_from_image_bytes.
+    :return: One list of embeddings per input array, in the same order.
+    """
+    _ensure_loaded()
+
+    embeddings = get_embeddings_from_aligned_faces(np.concatenate(face_batches), session=arcface_session)
+    boundaries = np.cumsum([len(faces) for faces in face_batches])[:-1]
+    return [list(batch) for batch in np.split(embeddings, boundaries)]
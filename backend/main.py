@@ -1,30 +1,144 @@
 import os
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse # Added
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
+from cachetools import TTLCache
 from datetime import datetime, timedelta
 import shutil # Added
+import asyncio
+import concurrent.futures
+import logging
+import logging.handlers
+import queue
+import multiprocessing
+import numpy as np
 import os # Already present, but good to note for UPLOADS_DIR
 
 import crud, models, schemas
 from database import SessionLocal, engine, Base
 import backend.face_processor as face_processor
 import backend.vector_db as vector_db
-
-# Инициализация
-models.Base.metadata.create_all(bind=engine)
+from backend.batching import MicroBatcher
+import backend.auth_cache as auth_cache
+from backend.request_limits import LimitRequestSizeMiddleware
+import backend.response_structs as response_structs
+
+# Log records are queued and written by a listener thread, so handlers never block on stdout
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+log = logging.getLogger("attendance")
+log.setLevel(logging.INFO)
+
+# Инициализация (schema is created on startup, see init_db)
+def _create_schema(connection):
+    models.Base.metadata.create_all(bind=connection)
+    # create_all skips tables that already exist, so add any indexes introduced since then
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
 
 # File Uploads Directory
 UPLOADS_DIR = "uploads/lesson_files"
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
-# Face Recognition Threshold (lower is better for L2 distance)
-FACE_RECOGNITION_THRESHOLD = 0.6 
+# Face Recognition Threshold: minimum cosine similarity (higher is better) between the upload and
+# the registered face. 0.7 matches the former squared-L2 cut-off of 0.6 on unit vectors.
+# Configurable so it can be re-calibrated for the index's storage precision
+FACE_SIMILARITY_THRESHOLD = float(os.getenv("FACE_SIMILARITY_THRESHOLD", "0.7"))
+
+# Largest accepted body for the endpoints that take a face photo (lesson file uploads are not limited)
+MAX_FACE_UPLOAD_SIZE = int(os.getenv("MAX_FACE_UPLOAD_SIZE", 10 * 1024 * 1024))
+FACE_UPLOAD_PATHS = ("/api/attendance/", "/api/users/me/register-face")
+
+# Face decoding/embedding is pure CPU work, so it runs in worker processes instead of blocking
+# the event loop. Each worker loads its own models (see face_processor.init_worker).
+# Spawned rather than forked: ONNX Runtime's thread pools are not fork-safe.
+# Every worker holds its own copy of the models, so the default stays small whatever the core count.
+FACE_POOL_WORKERS = int(os.getenv("FACE_POOL_WORKERS", min(os.cpu_count() or 1, 4)))
+
+def _new_face_pool():
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=FACE_POOL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=face_processor.init_worker,
+        initargs=(FACE_POOL_WORKERS,),
+    )
+
+FACE_POOL = _new_face_pool()
+
+def _read_into_presized(upload_file) -> bytearray:
+    # Size is known up front (the upload is already spooled), so read straight into one
+    # buffer instead of letting read() grow and copy a bytes object
+    upload_file.seek(0, os.SEEK_END)
+    size = upload_file.tell()
+    upload_file.seek(0)
+    buffer = bytearray(size)
+    filled = 0
+    with memoryview(buffer) as view:
+        while filled < size:
+            n = upload_file.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+    del buffer[filled:]
+    return buffer
+
+async def read_upload(file: UploadFile) -> bytearray:
+    return await asyncio.to_thread(_read_into_presized, file.file)
+
+# Decoding, detection and alignment run per request, spread over the FACE_POOL workers; only the
+# aligned 112x112 crops of requests arriving together (e.g. a whole class registering at roll call)
+# are coalesced, so ArcFace runs on many faces at once instead of one run per request.
+# Both stages are awaited on FACE_POOL directly, so no thread of the default executor (which runs
+# the FAISS search batches) sits blocked on them.
+FACE_EMBED_BATCH = 16
+
+_embed_batcher = MicroBatcher(face_processor.embed_aligned_faces, max_batch=FACE_EMBED_BATCH, executor=FACE_POOL)
+
+async def embed_faces(image_bytes: bytes | bytearray):
+    pool = FACE_POOL
+    loop = asyncio.get_running_loop()
+    try:
+        aligned_faces = await loop.run_in_executor(pool, face_processor.align_faces_from_image_bytes, image_bytes)
+        if len(aligned_faces) == 0:
+            return []
+        return await _embed_batcher.submit(aligned_faces)
+    except concurrent.futures.process.BrokenProcessPool:
+        _replace_face_pool(pool)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Face processing was interrupted. Please try again.")
+
+def _replace_face_pool(broken_pool):
+    # A worker died (e.g. killed for memory) and the pool now refuses all work; start a new one.
+    # Every request caught in the crash ends up here, but only the first replaces the pool.
+    global FACE_POOL
+    if FACE_POOL is not broken_pool:
+        return
+    log.error("A face worker process died; restarting the face worker pool.")
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+    FACE_POOL = _new_face_pool()
+    _embed_batcher.executor = FACE_POOL
+
+# Registrations only append to the FAISS WAL; the full index is rewritten this often (and at shutdown)
+FAISS_SNAPSHOT_INTERVAL = 60 # seconds
+
+async def _faiss_snapshot_loop():
+    while True:
+        await asyncio.sleep(FAISS_SNAPSHOT_INTERVAL)
+        await asyncio.to_thread(vector_db.snapshot)
+
+# Coalesces FAISS lookups from concurrent attendance requests into one index.search call
+_search_batcher = MicroBatcher(lambda queries: vector_db.search_embeddings_batch(np.stack(queries), k=1))
 
 app = FastAPI()
+# Face uploads are read into memory whole, so oversized bodies are refused before buffering.
+# Added before CORS so that CORS wraps it and browsers can read the 413.
+app.add_middleware(LimitRequestSizeMiddleware, max_size=MAX_FACE_UPLOAD_SIZE, path_prefixes=FACE_UPLOAD_PATHS)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -33,68 +147,147 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_log_listener():
+    _log_listener.start()
+
+@app.on_event("startup")
+async def init_db():
+    async with engine.begin() as connection:
+        await connection.run_sync(_create_schema)
+
+@app.on_event("startup")
+async def start_faiss_snapshots():
+    app.state.faiss_snapshot_task = asyncio.create_task(_faiss_snapshot_loop())
+
+@app.on_event("shutdown")
+def shutdown_face_pool():
+    FACE_POOL.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def stop_faiss_snapshots():
+    app.state.faiss_snapshot_task.cancel()
+    await asyncio.to_thread(vector_db.snapshot)
+
+@app.on_event("shutdown")
+def stop_log_listener():
+    _log_listener.stop() # Drains queued records before returning
+
 # Конфиг JWT
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+if not SECRET_KEY or not ALGORITHM:
+    raise RuntimeError("SECRET_KEY and ALGORITHM must be set")
+# Derived once at import instead of on every token issue/verification
+_SIGNING_KEY = SECRET_KEY.encode()
+_ALGORITHMS = [ALGORITHM]
+_DEFAULT_TOKEN_EXPIRY = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
 # DB dependency
 
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
 
 # Аутентификация
 
-def authenticate(db: Session, username: str, password: str):
-    user = crud.get_user_by_username(db, username)
-    if user and crud.pwd_context.verify(password, user.hashed_password):
-        return user
-    return None
+async def authenticate(db: AsyncSession, username: str, password: str):
+    user = await crud.get_user_by_username(db, username)
+    if not user:
+        return None
+    verified, new_hash = await crud.verify_and_update_password(password, user.hashed_password)
+    if not verified:
+        return None
+    if new_hash: # Legacy bcrypt hash: upgrade to argon2id on successful login
+        user.hashed_password = new_hash
+        await db.commit()
+    return user
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    expire = datetime.utcnow() + (expires_delta or _DEFAULT_TOKEN_EXPIRY)
+    return jwt.encode({**data, "exp": expire}, _SIGNING_KEY, algorithm=ALGORITHM)
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> auth_cache.CurrentUser:
+    # A JWT is always header.payload.signature; anything else is refused before any decoding
+    if not token or token.count('.') != 2:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    # Recently verified tokens skip signature verification and the user lookup
+    user = auth_cache.get_user(token)
+    if user is not None:
+        return user
+    if auth_cache.is_rejected(token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, _SIGNING_KEY, algorithms=_ALGORITHMS)
         username: str = payload.get("sub")
         if username is None: raise
     except JWTError:
+        auth_cache.put_rejected(token)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    db_user = await crud.get_user_by_username(db, username)
+    if db_user is None:
+        auth_cache.put_rejected(token)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-    user = crud.get_user_by_username(db, username)
-    if user is None: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    # A plain snapshot, not the ORM object: it is shared with later requests through the cache
+    user = auth_cache.CurrentUser(db_user.id, db_user.username, db_user.role)
+    auth_cache.put_user(token, user, payload.get("exp"))
     return user
 
+async def require_teacher(current_user: auth_cache.CurrentUser = Depends(get_current_user)) -> auth_cache.CurrentUser:
+    # get_current_user is cached per request, so endpoints that also need it don't pay twice
+    if current_user.role != 'teacher':
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only teachers can perform this action")
+    return current_user
+
 # Маршруты
 
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await authenticate(db, form_data.username, form_data.password)
     if not user: raise HTTPException(status_code=400, detail="Incorrect credentials")
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.post("/api/users", response_model=schemas.UserRead)
-async def api_create_user(user: schemas.UserCreate, current: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current.role != 'teacher': raise HTTPException(403)
-    return crud.create_user(db, user)
+# Serialized user pages keyed by (after_id, limit); short TTL since polling teachers mostly hit the first page
+_users_page_cache = TTLCache(maxsize=16, ttl=2)
+
+def _invalidate_users_pages():
+    # Pages embed each user's taught lessons and enrollments, so lesson and enrollment changes count too
+    _users_page_cache.clear()
 
-@app.get("/api/users", response_model=list[schemas.UserRead])
-async def api_list_users(current: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current.role != 'teacher': raise HTTPException(403)
-    return db.query(models.User).all()
+async def _list_users_page(db: AsyncSession, after_id: int | None, limit: int) -> bytes:
+    key = (after_id, limit)
+    page = _users_page_cache.get(key)
+    if page is None:
+        users = await crud.get_users(db, after_id=after_id, limit=limit)
+        next_cursor = users[-1].id if len(users) == limit else None
+        page = schemas.UserPage.model_validate({"items": users, "next_cursor": next_cursor}, from_attributes=True)\
+            .model_dump_json().encode()
+        _users_page_cache[key] = page
+    return page
+
+@app.post("/api/users", response_model=schemas.UserRead)
+async def api_create_user(user: schemas.UserCreate, current: auth_cache.CurrentUser = Depends(require_teacher), db: AsyncSession = Depends(get_db)):
+    db_user = await crud.create_user(db, user)
+    _invalidate_users_pages()
+    return db_user
+
+@app.get("/api/users", response_model=schemas.UserPage)
+async def api_list_users(
+    after_id: int | None = None,
+    limit: int = Query(100, ge=1, le=500),
+    current: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
+):
+    # Cached pages are already-serialized JSON, so hits skip both the query and Pydantic
+    return Response(content=await _list_users_page(db, after_id, limit), media_type="application/json")
 
 @app.post("/api/impersonate/{user_id}")
-async def impersonate(user_id: int, current: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current.role != 'teacher': raise HTTPException(403)
-    target = db.get(models.User, user_id)
+async def impersonate(user_id: int, current: auth_cache.CurrentUser = Depends(require_teacher), db: AsyncSession = Depends(get_db)):
+    target = await db.get(models.User, user_id)
     token = create_access_token(data={"sub": target.username})
     return {"access_token": token}
 
@@ -102,12 +295,12 @@ async def impersonate(user_id: int, current: models.User = Depends(get_current_u
 async def api_mark_attendance(
     lesson_id: int,
     file: UploadFile = File(...),
-    current_user: models.User = Depends(get_current_user), # Renamed user to current_user for clarity
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(get_current_user), # Renamed user to current_user for clarity
+    db: AsyncSession = Depends(get_db)
 ):
     # Authorization and Enrollment Check
     if current_user.role == 'student':
-        enrollment = crud.get_enrollment(db, student_id=current_user.id, lesson_id=lesson_id)
+        enrollment = await crud.get_enrollment(db, student_id=current_user.id, lesson_id=lesson_id)
         if not enrollment:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Student not enrolled in this lesson.")
     elif current_user.role == 'teacher':
@@ -118,12 +311,12 @@ async def api_mark_attendance(
         # pass
     
     # Read Image and Extract Embedding
-    image_bytes = await file.read()
+    image_bytes = await read_upload(file)
     if not image_bytes:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No image file provided.")
 
     try:
-        embeddings = face_processor.get_face_embeddings_from_image_bytes(image_bytes)
+        embeddings = await embed_faces(image_bytes)
 
         if not embeddings:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No face detected in attendance image.")
@@ -134,83 +327,91 @@ async def api_mark_attendance(
         query_embedding = embeddings[0]
 
         # Search for Matching Face in FAISS and Verify
-        search_results = vector_db.search_embedding(query_embedding=query_embedding, k=1)
+        search_results = await _search_batcher.submit(query_embedding)
 
         if not search_results:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Face not recognized in our database.")
 
-        matched_user_id, distance = search_results[0]
+        matched_user_id, similarity = search_results[0]
         
-        if matched_user_id == current_user.id and distance < FACE_RECOGNITION_THRESHOLD:
-            verified_similarity_score = max(0.0, 1.0 - distance) # Convert L2 distance to a similarity score (0 to 1)
+        if matched_user_id == current_user.id and similarity >= FACE_SIMILARITY_THRESHOLD:
+            verified_similarity_score = max(0.0, similarity) # Cosine similarity, clamped to 0..1
             
             # Record Attendance
-            db_att = crud.create_attendance(db=db, user_id=current_user.id, att=schemas.AttendanceCreate(lesson_id=lesson_id, similarity=verified_similarity_score))
-            print(f"Attendance confirmed for user {current_user.username} (ID: {current_user.id}) for lesson {lesson_id} with similarity {verified_similarity_score:.4f}.")
-            return schemas.AttendanceRead.model_validate(db_att) # Use model_validate for Pydantic v2
+            db_att = await crud.create_attendance(db=db, user_id=current_user.id, att=schemas.AttendanceCreate(lesson_id=lesson_id, similarity=verified_similarity_score))
+            log.info("Attendance confirmed for user %s (ID: %s) for lesson %s with similarity %.4f.", current_user.username, current_user.id, lesson_id, verified_similarity_score)
+            return db_att # Validated once by response_model
         else:
-            detail_msg = f"Face verification failed. Match distance: {distance:.4f}."
+            detail_msg = f"Face verification failed. Match similarity: {similarity:.4f}."
             if matched_user_id != current_user.id:
-                print(f"Security Alert: User {current_user.username} (ID: {current_user.id}) attendance attempt matched user ID {matched_user_id}.")
+                log.warning("Security Alert: User %s (ID: %s) attendance attempt matched user ID %s.", current_user.username, current_user.id, matched_user_id)
                 detail_msg = "Face does not match registered profile for the current user."
             
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=detail_msg)
 
+    except HTTPException:
+        raise # The 400/403 outcomes above, not unexpected errors
     except FileNotFoundError as e: 
-        print(f"CRITICAL: Model file not found during attendance marking: {e}")
+        log.critical("Model file not found during attendance marking: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Face processing models not available. Please contact support.")
     except ValueError as e: 
-        print(f"Value error during attendance marking for user {current_user.username} (ID: {current_user.id}): {e}")
+        log.warning("Value error during attendance marking for user %s (ID: %s): %s", current_user.username, current_user.id, e)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
-        print(f"Unexpected error during attendance marking for user {current_user.username} (ID: {current_user.id}): {e}")
+        log.exception("Unexpected error during attendance marking for user %s (ID: %s): %s", current_user.username, current_user.id, e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An unexpected error occurred during face verification.")
 
 
+def _list_response(adapter, objs) -> Response:
+    """
+    Serializes ORM objects with one of the precompiled list adapters in schemas and returns the JSON as is,
+    so FastAPI does not validate the response again against response_model.
+    """
+    return Response(content=adapter.dump_json(adapter.validate_python(objs, from_attributes=True)),
+                    media_type="application/json")
+
 @app.get("/api/attendance", response_model=list[schemas.AttendanceRead])
-async def api_list_attendance(current: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def api_list_attendance(current: auth_cache.CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if current.role not in ['teacher', 'student']: raise HTTPException(403)
-    records = crud.get_attendance(db)
-    return records
+    records = await crud.get_attendance(db)
+    return _list_response(schemas.AttendanceReadListAdapter, records)
 
 # Lesson Endpoints
 
 @app.post("/api/lessons", response_model=schemas.LessonRead, status_code=status.HTTP_201_CREATED)
 async def create_lesson_endpoint(
     lesson: schemas.LessonCreate,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    if current_user.role != 'teacher':
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only teachers can create lessons")
-    return crud.create_lesson(db, lesson=lesson, teacher_id=current_user.id)
+    db_lesson = await crud.create_lesson(db, lesson=lesson, teacher_id=current_user.id)
+    _invalidate_users_pages()
+    return db_lesson
 
 @app.get("/api/lessons", response_model=list[schemas.LessonRead])
 async def get_lessons_for_teacher_endpoint(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    if current_user.role != 'teacher':
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only teachers can view their lessons list")
-    return crud.get_lessons_by_teacher(db, teacher_id=current_user.id)
+    lessons = await crud.get_lessons_by_teacher(db, teacher_id=current_user.id)
+    return response_structs.json_response(lessons, list[response_structs.LessonRead])
 
 @app.get("/api/lessons/{lesson_id}", response_model=schemas.LessonRead)
 async def get_lesson_endpoint(
     lesson_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson_with_files_and_enrollments(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
 
     if current_user.role == 'teacher' and db_lesson.teacher_id == current_user.id:
-        return db_lesson
+        return response_structs.json_response(db_lesson, response_structs.LessonRead)
     
-    if current_user.role == 'student':
-        enrollment = crud.get_enrollment(db, student_id=current_user.id, lesson_id=lesson_id)
-        if enrollment:
-            return db_lesson
+    # Enrollments are already loaded, so check membership without another query
+    if current_user.role == 'student' and current_user.id in {e.user_id for e in db_lesson.enrollments}:
+        return response_structs.json_response(db_lesson, response_structs.LessonRead)
             
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view this lesson")
 
@@ -218,27 +419,28 @@ async def get_lesson_endpoint(
 async def update_lesson_endpoint(
     lesson_id: int,
     lesson_update: schemas.LessonCreate,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
     if db_lesson.teacher_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the lesson teacher can update it")
     
-    updated_lesson = crud.update_lesson(db, lesson_id=lesson_id, lesson_update=lesson_update)
+    updated_lesson = await crud.update_lesson(db, lesson_id=lesson_id, lesson_update=lesson_update)
     if updated_lesson is None: # Should not happen if previous checks passed
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found after update attempt")
+    _invalidate_users_pages()
     return updated_lesson
 
 @app.delete("/api/lessons/{lesson_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_lesson_endpoint(
     lesson_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson_with_files_and_enrollments(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
     if db_lesson.teacher_id != current_user.id:
@@ -247,34 +449,68 @@ async def delete_lesson_endpoint(
     # Delete associated files
     for lesson_file in db_lesson.files:
         file_path = lesson_file.file_path
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except OSError as e:
-                # Log this error, but continue with deleting the lesson from DB
-                print(f"Error deleting file {file_path}: {e}") 
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass # Already gone
+        except OSError as e:
+            # Log this error, but continue with deleting the lesson from DB
+            log.warning("Error deleting file %s: %s", file_path, e)
         # No need to call crud.delete_lesson_file here as cascade delete should handle it from LessonFile model,
         # or if not, the lesson deletion itself will make them inaccessible.
         # However, explicit deletion can be done if cascade is not set or for safety.
 
-    deleted_lesson = crud.delete_lesson(db, lesson_id=lesson_id)
+    deleted_lesson = await crud.delete_lesson(db, lesson_id=lesson_id)
     if deleted_lesson is None: # Should not happen if previous checks passed
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found during delete attempt")
+    _invalidate_users_pages()
     return None # For 204 No Content
 
 # Lesson File Endpoints
 
+UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024 # Userspace fallback chunk size
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset_src=offset)
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+def _fast_copy(src_file, dst_path):
+    """
+    Copies an uploaded (spooled) file to dst_path inside the kernel: copy_file_range, then
+    sendfile, then a userspace copy with a large buffer where neither is supported.
+    Blocking; run it in a worker thread.
+    """
+    src_fd = src_file.fileno() # Spooled uploads still in memory are rolled over to a temp file
+    size = os.fstat(src_fd).st_size
+    with open(dst_path, "wb") as dst_file:
+        dst_fd = dst_file.fileno()
+        offset = 0
+        for kernel_copy in (_copy_file_range, _sendfile):
+            try:
+                while offset < size:
+                    copied = kernel_copy(src_fd, dst_fd, offset, size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                return
+            except (AttributeError, OSError): # Not available on this platform/filesystem; keep what was copied
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+        src_file.seek(offset)
+        shutil.copyfileobj(src_file, dst_file, UPLOAD_COPY_BUFFER_SIZE)
+
 @app.post("/api/lessons/{lesson_id}/files", response_model=schemas.LessonFileRead, status_code=status.HTTP_201_CREATED)
 async def upload_lesson_file_endpoint(
     lesson_id: int,
     file: UploadFile = File(...),
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
-    if current_user.role != 'teacher' or db_lesson.teacher_id != current_user.id:
+    if db_lesson.teacher_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the lesson teacher can upload files")
 
     file_location = os.path.join(UPLOADS_DIR, f"{lesson_id}_{db_lesson.id}_{file.filename}") # Added lesson.id to file path for uniqueness
@@ -286,97 +522,92 @@ async def upload_lesson_file_endpoint(
 
 
     try:
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
+        await asyncio.to_thread(_fast_copy, file.file, file_location)
     except Exception as e:
         # Log error e
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Could not save file: {e}")
 
-    db_lesson_file = crud.create_lesson_file(db, file_name=file.filename, file_path=file_location, lesson_id=lesson_id)
+    db_lesson_file = await crud.create_lesson_file(db, file_name=file.filename, file_path=file_location, lesson_id=lesson_id)
     return db_lesson_file
 
 @app.get("/api/lessons/{lesson_id}/files", response_model=list[schemas.LessonFileRead])
 async def get_lesson_files_endpoint(
     lesson_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson_with_files_and_enrollments(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
 
+    # Files and enrollments come with the lesson, so neither check nor response needs another query
     if current_user.role == 'teacher' and db_lesson.teacher_id == current_user.id:
-        return crud.get_lesson_files(db, lesson_id=lesson_id)
+        return _list_response(schemas.LessonFileReadListAdapter, db_lesson.files)
     
-    if current_user.role == 'student':
-        enrollment = crud.get_enrollment(db, student_id=current_user.id, lesson_id=lesson_id)
-        if enrollment:
-            return crud.get_lesson_files(db, lesson_id=lesson_id)
+    if current_user.role == 'student' and current_user.id in {e.user_id for e in db_lesson.enrollments}:
+        return _list_response(schemas.LessonFileReadListAdapter, db_lesson.files)
             
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view these files")
 
 @app.get("/api/files/{file_id}/download", response_class=FileResponse)
 async def download_lesson_file_endpoint(
     file_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_file = crud.get_lesson_file(db, file_id=file_id)
-    if db_file is None:
+    # File, lesson owner and the caller's enrollment in a single query
+    row = await crud.get_file_with_authz(db, file_id=file_id, user_id=current_user.id)
+    if row is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    db_file, teacher_id, enrolled = row
 
-    db_lesson = crud.get_lesson(db, lesson_id=db_file.lesson_id)
-    if db_lesson is None: # Should not happen if file exists, but good practice
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Associated lesson not found")
-
-    if current_user.role == 'teacher' and db_lesson.teacher_id == current_user.id:
+    if current_user.role == 'teacher' and teacher_id == current_user.id:
+        pass # Authorized
+    elif current_user.role == 'student' and enrolled:
         pass # Authorized
-    elif current_user.role == 'student':
-        enrollment = crud.get_enrollment(db, student_id=current_user.id, lesson_id=db_file.lesson_id)
-        if not enrollment:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to download this file")
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to download this file")
     
-    if not os.path.exists(db_file.file_path):
+    # One stat call both checks existence and is handed to FileResponse so it doesn't stat again
+    try:
+        stat_result = os.stat(db_file.file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found on server")
 
-    return FileResponse(path=db_file.file_path, filename=db_file.filename, media_type='application/octet-stream')
+    return FileResponse(path=db_file.file_path, filename=db_file.filename, media_type='application/octet-stream', stat_result=stat_result)
 
 @app.delete("/api/files/{file_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_lesson_file_endpoint(
     file_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_file = crud.get_lesson_file(db, file_id=file_id)
-    if db_file is None:
+    row = await crud.get_file_with_authz(db, file_id=file_id, user_id=current_user.id)
+    if row is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
-
-    db_lesson = crud.get_lesson(db, lesson_id=db_file.lesson_id)
-    if db_lesson is None: # Should not happen
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Associated lesson not found")
+    db_file, teacher_id, _ = row
     
-    if current_user.role != 'teacher' or db_lesson.teacher_id != current_user.id:
+    if teacher_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the lesson teacher can delete this file")
 
     file_path = db_file.file_path
     
-    deleted_db_file_entry = crud.delete_lesson_file(db, file_id=file_id)
+    deleted_db_file_entry = await crud.delete_lesson_file(db, file_id=file_id)
     if deleted_db_file_entry is None: # Should not happen if previous checks passed
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found during delete attempt from DB")
 
     # Physical file deletion after DB entry is confirmed deleted
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except OSError as e:
-            # Log this error. Consider if this should be a critical failure.
-            # For now, we've deleted the DB entry, so the file is orphaned.
-            print(f"Error deleting file {file_path}: {e}")
-            # Optionally, re-add the DB entry or raise a 500 error if physical deletion is critical
-            # crud.create_lesson_file(db, file_name=db_file.filename, file_path=db_file.file_path, lesson_id=db_file.lesson_id) # Rollback DB
-            # raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Could not delete file from disk: {e}")
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass # Already gone
+    except OSError as e:
+        # Log this error. Consider if this should be a critical failure.
+        # For now, we've deleted the DB entry, so the file is orphaned.
+        log.warning("Error deleting file %s: %s", file_path, e)
+        # Optionally, re-add the DB entry or raise a 500 error if physical deletion is critical
+        # crud.create_lesson_file(db, file_name=db_file.filename, file_path=db_file.file_path, lesson_id=db_file.lesson_id) # Rollback DB
+        # raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Could not delete file from disk: {e}")
     
     return None # For 204 No Content
 
@@ -386,13 +617,13 @@ async def delete_lesson_file_endpoint(
 async def enroll_student_endpoint(
     lesson_id: int,
     enrollment_req: schemas.StudentLessonEnrollmentCreate, # Assuming user_id is in the body, matching lesson_id from path
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
-    if current_user.role != 'teacher' or db_lesson.teacher_id != current_user.id:
+    if db_lesson.teacher_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the lesson teacher can enroll students")
 
     # Ensure enrollment_req explicitly sets the lesson_id from the path, or that it matches if also in body.
@@ -403,19 +634,41 @@ async def enroll_student_endpoint(
     if enrollment_req.lesson_id != lesson_id:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Lesson ID in path and request body must match")
 
-    target_user = db.get(models.User, enrollment_req.user_id)
+    target_user = await db.get(models.User, enrollment_req.user_id)
     if not target_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User to enroll not found")
     if target_user.role != 'student':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Can only enroll users with 'student' role")
 
-    # Check if already enrolled (crud.enroll_student already does this, but can be explicit here)
-    existing_enrollment = crud.get_enrollment(db, student_id=enrollment_req.user_id, lesson_id=lesson_id)
-    if existing_enrollment:
+    # The insert itself detects an existing enrollment, so no separate lookup is needed
+    db_enrollment, created = await crud.enroll_student(db, enrollment=enrollment_req)
+    if not created:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Student already enrolled in this lesson")
+    _invalidate_users_pages()
+    return db_enrollment
 
-    return crud.enroll_student(db, enrollment=enrollment_req)
 
+@app.post("/api/lessons/{lesson_id}/enroll/bulk", response_model=schemas.MessageResponse, status_code=status.HTTP_201_CREATED)
+async def bulk_enroll_students_endpoint(
+    lesson_id: int,
+    enrollment_req: schemas.StudentLessonEnrollmentBulkCreate,
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
+):
+    db_lesson = await crud.get_lesson(db, lesson_id=lesson_id)
+    if db_lesson is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
+    if db_lesson.teacher_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the lesson teacher can enroll students")
+
+    user_ids = set(enrollment_req.user_ids)
+    student_ids = await crud.get_student_ids(db, user_ids)
+    if student_ids != user_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Not existing students: {sorted(user_ids - student_ids)}")
+
+    await crud.bulk_enroll_students(db, lesson_id=lesson_id, user_ids=list(user_ids))
+    _invalidate_users_pages()
+    return schemas.MessageResponse(message=f"{len(user_ids)} students enrolled.")
 
 @app.delete("/api/lessons/{lesson_id}/unenroll", status_code=status.HTTP_204_NO_CONTENT)
 async def unenroll_student_endpoint(
@@ -423,59 +676,60 @@ async def unenroll_student_endpoint(
     # The spec says payload: schemas.StudentLessonEnrollmentBase, which requires user_id and lesson_id
     # This means the client needs to send a body: {"user_id": X, "lesson_id": Y}
     unenroll_req: schemas.StudentLessonEnrollmentBase, 
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(require_teacher),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_lesson = crud.get_lesson(db, lesson_id=lesson_id)
+    db_lesson = await crud.get_lesson(db, lesson_id=lesson_id)
     if db_lesson is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Lesson not found")
-    if current_user.role != 'teacher' or db_lesson.teacher_id != current_user.id:
+    if db_lesson.teacher_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only the lesson teacher can unenroll students")
 
     if unenroll_req.lesson_id != lesson_id:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Lesson ID in path and request body must match")
     
-    target_user = db.get(models.User, unenroll_req.user_id)
+    target_user = await db.get(models.User, unenroll_req.user_id)
     if not target_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User to unenroll not found")
     # No need to check role here, if they are enrolled, they should be unenrollable by teacher.
 
-    db_enrollment = crud.unenroll_student(db, student_id=unenroll_req.user_id, lesson_id=lesson_id)
+    db_enrollment = await crud.unenroll_student(db, student_id=unenroll_req.user_id, lesson_id=lesson_id)
     if db_enrollment is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Enrollment not found for this student and lesson")
-    
+    _invalidate_users_pages()
     return None # For 204 No Content
 
 # Student-Specific Endpoints
 
 @app.get("/api/student/lessons", response_model=list[schemas.LessonRead])
 async def get_student_lessons_endpoint(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: auth_cache.CurrentUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
     if current_user.role != 'student':
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only students can view their enrolled lessons")
-    return crud.get_lessons_for_student(db, student_id=current_user.id)
+    lessons = await crud.get_lessons_for_student(db, student_id=current_user.id)
+    return response_structs.json_response(lessons, list[response_structs.LessonRead])
 
 # User Face Registration Endpoint
 @app.post("/api/users/me/register-face", response_model=schemas.MessageResponse)
 async def register_face_for_student(
-    current_user: models.User = Depends(get_current_user),
-    # db: Session = Depends(get_db), # db not directly used here unless for logging user activity
+    current_user: auth_cache.CurrentUser = Depends(get_current_user),
+    # db: AsyncSession = Depends(get_db), # db not directly used here unless for logging user activity
     file: UploadFile = File(...)
 ):
     if current_user.role != 'student':
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only students can register faces.")
 
-    image_bytes = await file.read()
+    image_bytes = await read_upload(file)
     if not image_bytes:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No image file provided.")
 
     try:
-        # face_processor and vector_db models/indices are loaded on module import.
-        # If they failed to load, their respective functions will handle or raise errors.
+        # face_processor loads its models on first use and raises FileNotFoundError if they are missing;
+        # the vector_db index is loaded on module import.
         
-        embeddings = face_processor.get_face_embeddings_from_image_bytes(image_bytes)
+        embeddings = await embed_faces(image_bytes)
 
         if not embeddings:
             raise HTTPException(
@@ -491,30 +745,25 @@ async def register_face_for_student(
         
         embedding = embeddings[0]
         
-        # Delete any existing embeddings for this user to ensure only one face profile per user.
-        try:
-            removed_count = vector_db.delete_embeddings_by_user_id(current_user.id)
-            if removed_count > 0:
-                print(f"Removed {removed_count} existing embeddings for user {current_user.id} before adding new one.")
-        except Exception as e:
-            # Log this error but proceed with adding the new embedding.
-            # If save_faiss_data fails in delete_embeddings_by_user_id, it might be problematic.
-            # However, the main goal is to register the new face.
-            print(f"Error during pre-deletion of embeddings for user {current_user.id}: {e}")
-
-        faiss_id = vector_db.add_embedding(user_id=current_user.id, embedding=embedding)
+        # Replace any existing embeddings for this user to ensure only one face profile per user.
+        # This can copy or rebuild the index under its lock, so it runs off the event loop.
+        removed_count, index_size = await asyncio.to_thread(vector_db.replace_embeddings, current_user.id, embedding)
+        if removed_count > 0:
+            log.info("Replaced %d existing embeddings for user %s.", removed_count, current_user.id)
         
-        print(f"Registered face for user {current_user.username} (ID: {current_user.id}), FAISS ID (internal): {faiss_id}") # For logging
+        log.info("Registered face for user %s (ID: %s), FAISS index size: %s", current_user.username, current_user.id, index_size)
 
         return schemas.MessageResponse(message="Face registered successfully.")
 
+    except HTTPException:
+        raise # The 400 outcomes above, not unexpected errors
     except FileNotFoundError as e: 
         # This might occur if model files were deleted after initial load, or if load_models() was skipped/failed silently.
-        print(f"CRITICAL: Model file not found during face registration: {e}") # Changed to print for server log
+        log.critical("Model file not found during face registration: %s", e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Face processing models not available. Please contact support.")
     except ValueError as e: 
-        print(f"Value error during face registration for user {current_user.username} (ID: {current_user.id}): {e}")
+        log.warning("Value error during face registration for user %s (ID: %s): %s", current_user.username, current_user.id, e)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
-        print(f"Unexpected error during face registration for user {current_user.username} (ID: {current_user.id}): {e}")
+        log.exception("Unexpected error during face registration for user %s (ID: %s): %s", current_user.username, current_user.id, e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An unexpected error occurred during face registration.")
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -19,7 +19,7 @@ class Lesson(Base):
     title = Column(String, nullable=False)
     description = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    teacher_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    teacher_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
     teacher = relationship('User', back_populates='taught_lessons')
     files = relationship('LessonFile', back_populates='lesson', cascade="all, delete-orphan")
     enrollments = relationship('StudentLessonEnrollment', back_populates='lesson', cascade="all, delete-orphan")
@@ -35,16 +35,21 @@ class LessonFile(Base):
 
 class StudentLessonEnrollment(Base):
     __tablename__ = 'student_lesson_enrollments'
+    # The (user_id, lesson_id) primary key serves lookups by student; lesson_id gets its own
+    # index for loading a lesson's enrollments.
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
-    lesson_id = Column(Integer, ForeignKey('lessons.id'), primary_key=True)
+    lesson_id = Column(Integer, ForeignKey('lessons.id'), primary_key=True, index=True)
     student = relationship('User', back_populates='lesson_enrollments')
     lesson = relationship('Lesson', back_populates='enrollments')
 
 class Attendance(Base):
     __tablename__ = 'attendance'
+    # (user_id, lesson_id) serves per-student lookups, alone or per lesson; lesson_id gets its
+    # own index for per-lesson reports.
+    __table_args__ = (Index('ix_attendance_user_lesson', 'user_id', 'lesson_id'),)
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    lesson_id = Column(Integer, nullable=False)
+    lesson_id = Column(Integer, nullable=False, index=True)
     similarity = Column(Float, nullable=False)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     user = relationship('User', back_populates='records')
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+Offline preparation of the ML models used by face_processor.
+
+Run once from the project root before starting the API:
+
+    python backend/prepare_models.py
+
+This needs the export-time extras (ultralytics, onnx) that the API itself does not.
+"""
+import os
+import cv2
+import numpy as np
+
+YOLO_WEIGHTS_PATH = "backend/ml_models/yolov11n-face.pt"
+YOLO_INPUT_SIZE = 640
+ARCFACE_MODEL_PATH = "backend/ml_models/arcface_model.onnx"
+ARCFACE_INT8_MODEL_PATH = "backend/ml_models/arcface_int8.onnx"
+# Directory of ~200 aligned 112x112 face crops used to calibrate INT8 activations
+CALIBRATION_FACES_DIR = "backend/ml_models/calibration_faces"
+# Name of the ArcFace output once L2 normalization is part of the graph (see face_processor)
+ARCFACE_NORMALIZED_OUTPUT = "embedding_l2"
+
+
+def export_yolo():
+    """Exports the YOLO face detector to a fixed batch=1 ONNX graph next to the .pt weights."""
+    from ultralytics import YOLO
+
+    if not os.path.exists(YOLO_WEIGHTS_PATH):
+        raise FileNotFoundError(f"YOLO weights not found at {YOLO_WEIGHTS_PATH}")
+    model = YOLO(YOLO_WEIGHTS_PATH)
+    exported_path = model.export(format="onnx", imgsz=YOLO_INPUT_SIZE, batch=1, dynamic=False, simplify=True)
+    print(f"YOLO detector exported to {exported_path}")
+
+
+
+def make_arcface_batch_dynamic():
+    """Rewrites the ArcFace graph's batch axis to a symbolic 'N' so faces can be embedded in one run."""
+    import onnx
+
+    model = onnx.load(ARCFACE_MODEL_PATH)
+    for value in list(model.graph.input) + list(model.graph.output):
+        value.type.tensor_type.shape.dim[0].dim_param = 'N'
+    onnx.checker.check_model(model)
+    onnx.save(model, ARCFACE_MODEL_PATH)
+    print(f"ArcFace batch axis made dynamic in {ARCFACE_MODEL_PATH}")
+
+
+def append_arcface_l2_norm():
+    """Appends LpNormalization(p=2) to the ArcFace output so ORT returns unit-length embeddings."""
+    import onnx
+    from onnx import helper
+
+    model = onnx.load(ARCFACE_MODEL_PATH)
+    output = model.graph.output[0]
+    if output.name == ARCFACE_NORMALIZED_OUTPUT:
+        print("ArcFace output is already L2-normalized")
+        return
+
+    model.graph.node.append(helper.make_node(
+        "LpNormalization", inputs=[output.name], outputs=[ARCFACE_NORMALIZED_OUTPUT], axis=1, p=2))
+    normalized_output = onnx.ValueInfoProto()
+    normalized_output.CopyFrom(output)
+    normalized_output.name = ARCFACE_NORMALIZED_OUTPUT
+    model.graph.output.remove(output)
+    model.graph.output.append(normalized_output)
+    onnx.checker.check_model(model)
+    onnx.save(model, ARCFACE_MODEL_PATH)
+    print(f"L2 normalization appended to {ARCFACE_MODEL_PATH}")
+
+
+def _load_calibration_faces(faces_dir=CALIBRATION_FACES_DIR):
+    """Loads aligned face crops and preprocesses them exactly like face_processor does."""
+    blobs = []
+    for name in sorted(os.listdir(faces_dir)):
+        img = cv2.imread(os.path.join(faces_dir, name), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        img = cv2.resize(img, (112, 112))
+        img = (img.astype(np.float32) - 127.5) / 128.0
+        blobs.append(np.expand_dims(img.transpose((2, 0, 1)), axis=0))
+    if not blobs:
+        raise ValueError(f"No calibration images found in {faces_dir}")
+    return blobs
+
+
+def quantize_arcface():
+    """Statically quantizes ArcFace to INT8 (per-channel weights, QDQ format)."""
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    input_name = onnxruntime.InferenceSession(ARCFACE_MODEL_PATH, providers=['CPUExecutionProvider']).get_inputs()[0].name
+
+    class FaceCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self._blobs = iter(_load_calibration_faces())
+
+        def get_next(self):
+            blob = next(self._blobs, None)
+            return None if blob is None else {input_name: blob}
+
+    quantize_static(
+        ARCFACE_MODEL_PATH,
+        ARCFACE_INT8_MODEL_PATH,
+        FaceCalibrationReader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+    )
+    print(f"INT8 ArcFace written to {ARCFACE_INT8_MODEL_PATH}")
+
+
+if __name__ == '__main__':
+    export_yolo()
+    make_arcface_batch_dynamic()
+    append_arcface_l2_norm()
+    quantize_arcface()
@@ -0,0 +1,52 @@
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+
+DEFAULT_MAX_REQUEST_SIZE = 10 * 1024 * 1024 # bytes
+
+
+class LimitRequestSizeMiddleware:
+    """
+    Rejects request bodies larger than max_size with 413 before they are buffered.
+    A declared Content-Length over the limit is refused up front; chunked bodies are counted
+    as they arrive and cut off as soon as they cross it.
+    """
+
+    def __init__(self, app, max_size=DEFAULT_MAX_REQUEST_SIZE, path_prefixes=None):
+        """
+        :param app: The wrapped ASGI application.
+        :param max_size: Maximum body size in bytes.
+        :param path_prefixes: Only requests whose path starts with one of these are limited (None: all).
+        """
+        self.app = app
+        self.max_size = max_size
+        self.path_prefixes = tuple(path_prefixes) if path_prefixes is not None else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (
+                self.path_prefixes is not None and not scope["path"].startswith(self.path_prefixes)):
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                if value.isdigit() and int(value) > self.max_size:
+                    response = JSONResponse({"detail": "Request body too large"},
+                                            status_code=status.HTTP_413_CONTENT_TOO_LARGE)
+                    await response(scope, receive, send)
+                    return
+                break
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    # Raised while the endpoint reads its body, so FastAPI turns it into a 413 response
+                    raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                                        detail="Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
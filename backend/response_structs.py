@@ -0,0 +1,48 @@
+from datetime import datetime
+import msgspec
+from fastapi import Response
+
+# msgspec mirrors of the read-only lesson schemas in schemas.py, for the endpoints that return
+# lessons with all their files and enrollments. Building these straight from the ORM objects and
+# encoding them is much cheaper than pydantic validation + serialization. Field names and order
+# match the pydantic models, so the JSON is the same and response_model still documents it.
+
+
+class UserReadWithoutDetails(msgspec.Struct, frozen=True):
+    id: int
+    username: str
+    role: str
+
+
+class LessonFileReadWithoutLesson(msgspec.Struct, frozen=True):
+    id: int
+    filename: str
+    file_path: str
+    uploaded_at: datetime
+
+
+class StudentLessonEnrollmentReadWithoutLesson(msgspec.Struct, frozen=True):
+    user_id: int
+    student: UserReadWithoutDetails
+
+
+class LessonRead(msgspec.Struct, frozen=True):
+    title: str
+    description: str | None
+    id: int
+    teacher_id: int
+    created_at: datetime
+    files: list[LessonFileReadWithoutLesson]
+    enrollments: list[StudentLessonEnrollmentReadWithoutLesson]
+
+
+_encoder = msgspec.json.Encoder()
+
+
+def json_response(obj, struct_type, status_code: int = 200) -> Response:
+    """
+    Serializes ORM object(s) as struct_type (e.g. LessonRead or list[LessonRead]) into a JSON response.
+    Relationships used by the struct must already be loaded.
+    """
+    content = _encoder.encode(msgspec.convert(obj, struct_type, from_attributes=True))
+    return Response(content=content, media_type="application/json", status_code=status_code)
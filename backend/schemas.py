@@ -1,5 +1,5 @@
 from __future__ import annotations
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 from datetime import datetime
 
 class Token(BaseModel):
@@ -18,25 +18,27 @@ class UserCreate(UserBase):
 
 class UserRead(UserBase):
     id: int
-    taught_lessons: list[LessonReadWithoutTeacher] = []
-    lesson_enrollments: list[StudentLessonEnrollmentReadWithoutStudent] = []
-    class Config:
-        model_config = {"from_attributes": True}
+    taught_lessons: list[LessonReadWithoutTeacher] = Field(default_factory=list)
+    lesson_enrollments: list[StudentLessonEnrollmentReadWithoutStudent] = Field(default_factory=list)
+    model_config = ConfigDict(from_attributes=True)
 
-# Helper Schemas to avoid circular dependencies
+class UserPage(BaseModel):
+    items: list[UserRead]
+    next_cursor: int | None = None # Pass as after_id to fetch the next page; None on the last page
+
+# Helper Schemas to avoid circular dependencies. Only ever built from ORM objects for
+# responses, so they are frozen (immutable, hashable).
 
 class UserReadWithoutDetails(BaseModel):
     id: int
     username: str
     role: str
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 class LessonReadWithoutDetails(BaseModel):
     id: int
     title: str
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 class LessonReadWithoutTeacher(BaseModel): # For UserRead
     id: int
@@ -44,28 +46,24 @@ class LessonReadWithoutTeacher(BaseModel): # For UserRead
     description: str | None = None
     created_at: datetime
     # files and enrollments might be too much detail here, excluded for now
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 class LessonFileReadWithoutLesson(BaseModel): # For LessonRead
     id: int
     filename: str
     file_path: str
     uploaded_at: datetime
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 class StudentLessonEnrollmentReadWithoutLesson(BaseModel): # For LessonRead
     user_id: int
     student: UserReadWithoutDetails
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 class StudentLessonEnrollmentReadWithoutStudent(BaseModel): # For UserRead
     lesson_id: int
     lesson: LessonReadWithoutDetails
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 
 # Lesson Schemas
@@ -80,10 +78,9 @@ class LessonRead(LessonBase):
     id: int
     teacher_id: int
     created_at: datetime
-    files: list[LessonFileReadWithoutLesson] = []
-    enrollments: list[StudentLessonEnrollmentReadWithoutLesson] = []
-    class Config:
-        model_config = {"from_attributes": True}
+    files: list[LessonFileReadWithoutLesson] = Field(default_factory=list)
+    enrollments: list[StudentLessonEnrollmentReadWithoutLesson] = Field(default_factory=list)
+    model_config = ConfigDict(from_attributes=True)
 
 # LessonFile Schemas
 class LessonFileBase(BaseModel):
@@ -98,8 +95,7 @@ class LessonFileRead(LessonFileBase):
     uploaded_at: datetime
     lesson_id: int
     # lesson: LessonReadWithoutDetails # Optional: if you need basic lesson info here
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True)
 
 # StudentLessonEnrollment Schemas
 class StudentLessonEnrollmentBase(BaseModel):
@@ -109,11 +105,13 @@ class StudentLessonEnrollmentBase(BaseModel):
 class StudentLessonEnrollmentCreate(StudentLessonEnrollmentBase):
     pass
 
+class StudentLessonEnrollmentBulkCreate(BaseModel):
+    user_ids: list[int] = Field(..., min_length=1)
+
 class StudentLessonEnrollmentRead(StudentLessonEnrollmentBase):
     student: UserReadWithoutDetails
     lesson: LessonReadWithoutDetails
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True)
 
 class AttendanceBase(BaseModel):
     lesson_id: int
@@ -125,9 +123,18 @@ class AttendanceRead(AttendanceCreate):
     id: int
     user_id: int
     timestamp: datetime
-    class Config:
-        model_config = {"from_attributes": True}
+    model_config = ConfigDict(from_attributes=True)
 
 # Generic Message Response
 class MessageResponse(BaseModel):
-    message: str
\ No newline at end of file
+    message: str
+
+# Resolve the forward references (e.g. UserRead -> LessonReadWithoutTeacher) now, at import,
+# rather than on first use
+UserRead.model_rebuild()
+UserPage.model_rebuild()
+
+# Validators/serializers for the list responses, compiled once here instead of per request.
+# Lesson lists go through response_structs (msgspec) instead.
+AttendanceReadListAdapter = TypeAdapter(list[AttendanceRead])
+LessonFileReadListAdapter = TypeAdapter(list[LessonFileRead])
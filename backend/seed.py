@@ -1,25 +1,40 @@
-from sqlalchemy.orm import Session
-from fastapi_attendance_mvp.backend.database import SessionLocal, engine, Base
+import asyncio
+import concurrent.futures
+import os
+from argon2 import PasswordHasher, Type
+from sqlalchemy import insert
+from database import SessionLocal, engine, Base
 import models
-from passlib.context import CryptContext
+from crud import ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM
 
-# Инициализация схемы
-Base.metadata.create_all(bind=engine)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Same argon2id parameters as the app (see crud.pwd_context), called directly rather than
+# through passlib's CryptContext; the hashes verify the same way at login
+password_hasher = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST,
+                                 parallelism=ARGON2_PARALLELISM, type=Type.ID)
 
-def seed():
-    db: Session = SessionLocal()
-    users = [
-        {"username": "student1", "password": "password123", "role": "student"},
-        {"username": "teacher1", "password": "password123", "role": "teacher"},
-    ]
-    for u in users:
-        hashed = pwd_context.hash(u["password"])
-        db_user = models.User(username=u["username"], password=hashed, role=u["role"])
-        db.add(db_user)
-    db.commit()
-    db.close()
+def hash_passwords(passwords: list[str]) -> list[str]:
+    # argon2 is deliberately slow and CPU-bound: hash on all cores at once instead of one by one
+    workers = min(os.cpu_count() or 1, len(passwords)) or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(password_hasher.hash, passwords))
+
+async def seed():
+    # Инициализация схемы
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    async with SessionLocal() as db:
+        users = [
+            {"username": "student1", "password": "password123", "role": "student"},
+            {"username": "teacher1", "password": "password123", "role": "teacher"},
+        ]
+        hashes = hash_passwords([u["password"] for u in users])
+        # One executemany INSERT instead of an ORM unit of work per user
+        await db.execute(insert(models.User), [
+            {"username": u["username"], "hashed_password": hashed, "role": u["role"]}
+            for u, hashed in zip(users, hashes)
+        ])
+        await db.commit()
 
 if __name__ == '__main__':
-    seed()
-    print("Users seeded: student1/teacher1, password: password123")
\ No newline at end of file
+    asyncio.run(seed())
+    print("Users seeded: student1/teacher1, password: password123")
@@ -1,61 +1,286 @@
+import atexit
+from collections import Counter
 import faiss
 import numpy as np
 import os
 import pickle
+import struct
+import threading
+import time
 
 # Define constants
 FAISS_INDEX_PATH = "backend/ml_models/faiss_user_embeddings.index"
-ID_MAP_PATH = "backend/ml_models/faiss_id_to_user_id.pkl"
+# Position -> user_id map kept next to indexes saved before user_ids were stored in the index itself
+LEGACY_ID_MAP_PATH = "backend/ml_models/faiss_id_to_user_id.pkl"
+# Adds/deletes since the last snapshot of the index, replayed on load
+WAL_PATH = "backend/ml_models/faiss_wal.log"
 EMBEDDING_DIMENSION = 512  # Should match ArcFace output dimension
+# Below this many vectors an exact scan is cheaper than walking an HNSW graph
+HNSW_MIN_SIZE = 1000
+# An HNSW index shrinking through deletions stays HNSW down to this size, so an index hovering
+# around HNSW_MIN_SIZE is not rebuilt back and forth between the two kinds
+HNSW_KEEP_SIZE = HNSW_MIN_SIZE // 2
+HNSW_NEIGHBORS = 32 # Graph degree (M)
+HNSW_EF_CONSTRUCTION = 40
+HNSW_EF_SEARCH = 16
+# GPU that searches run on when FAISS is built with GPU support; a negative value keeps them on CPU
+FAISS_GPU_DEVICE = int(os.getenv("FAISS_GPU_DEVICE", "0"))
 
 # Initialize global variables
+# CPU index: source of truth for persistence and rebuilds. An IndexIDMap2 whose ids are our
+# user_ids, so search results need no translation and deletions are a remove_ids call.
 faiss_index = None
-id_to_user_id_map = {}  # Maps internal FAISS contiguous IDs to our user_ids
-next_faiss_id = 0  # Counter for next available FAISS ID
+search_index = None # What searches run against: a GPU mirror of faiss_index, or faiss_index itself
+_gpu_resources = None
+# The index as loaded, with its vectors memory-mapped from FAISS_INDEX_PATH. Mapped storage
+# cannot grow or shrink (FAISS aborts the process), so it is copied into memory before the
+# first mutation; see _ensure_writable
+_mapped_index = None
+# user_id -> number of stored embeddings, so deleting a user with none (every first face
+# registration) is answered without scanning the index's ids
+_user_embedding_counts = Counter()
+# Searches run in worker threads (see batching.MicroBatcher), so index reads, mutations,
+# WAL appends and snapshots are serialized
+_index_lock = threading.RLock()
+_wal_file = None # Opened once for appending; see _wal_append
+# False until load_faiss_data succeeds: an index that was reset because loading failed must never
+# be snapshotted over the files it failed to load
+_snapshots_enabled = False
+# WAL record: operation code and user_id, followed for adds by the raw float32 embedding
+_WAL_HEADER = struct.Struct('<cq')
+_WAL_ADD = b'A'
+_WAL_DELETE = b'D'
+_WAL_VECTOR_SIZE = EMBEDDING_DIMENSION * np.dtype(np.float32).itemsize
+_PICKLE_PROTOCOL_MARKER = b'\x80' # First byte of WALs written as pickled tuples by older versions
 
 def _ensure_ml_models_dir_exists():
     """Ensures the directory for ML models exists."""
     os.makedirs(os.path.dirname(FAISS_INDEX_PATH), exist_ok=True)
 
+def _new_index(expected_size=0, hnsw_min_size=HNSW_MIN_SIZE):
+    """
+    Empty embedding index, keyed by user_id, storing vectors as FP16: half the memory and
+    bandwidth of IndexFlatL2, with negligible loss for face embeddings. Vectors are unit length,
+    so inner product is their cosine similarity (higher is closer). Small indexes are
+    scanned exactly; from HNSW_MIN_SIZE vectors on, an HNSW graph keeps searches logarithmic.
+    :param expected_size: Number of vectors about to be added.
+    :param hnsw_min_size: Size from which an HNSW graph is built.
+    """
+    if expected_size < hnsw_min_size:
+        base_index = faiss.IndexScalarQuantizer(EMBEDDING_DIMENSION, faiss.ScalarQuantizer.QT_fp16,
+                                                faiss.METRIC_INNER_PRODUCT)
+    else:
+        base_index = faiss.IndexHNSWSQ(EMBEDDING_DIMENSION, faiss.ScalarQuantizer.QT_fp16, HNSW_NEIGHBORS,
+                                       faiss.METRIC_INNER_PRODUCT)
+        base_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        base_index.hnsw.efSearch = HNSW_EF_SEARCH
+    return faiss.IndexIDMap2(base_index)
+
+
+def _build_index(vectors, user_ids, hnsw_min_size=HNSW_MIN_SIZE):
+    """New index (of the kind suited to its size) holding the given (N, EMBEDDING_DIMENSION) vectors."""
+    index = _new_index(len(vectors), hnsw_min_size)
+    if len(vectors) > 0:
+        index.add_with_ids(vectors, user_ids)
+    return index
+
+
+def _is_hnsw(index):
+    return isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW)
+
+
+def _stored_vectors(index):
+    """All vectors of an id-mapped index, in storage order (the order of _stored_user_ids)."""
+    return index.index.reconstruct_n(0, index.ntotal)
+
+
+def _stored_user_ids(index):
+    return faiss.vector_to_array(index.id_map)
+
+
+def _mirror_to_gpu(cpu_index):
+    """
+    Returns a copy of cpu_index on FAISS_GPU_DEVICE when a GPU build of FAISS sees that device,
+    otherwise cpu_index itself. Brute-force search is an order of magnitude faster there.
+    """
+    global _gpu_resources
+    if not hasattr(faiss, "StandardGpuResources") or not 0 <= FAISS_GPU_DEVICE < faiss.get_num_gpus():
+        return cpu_index
+    try:
+        if _gpu_resources is None:
+            _gpu_resources = faiss.StandardGpuResources() # Allocated once, shared by all mirrors
+        # GPU FAISS has no flat scalar-quantizer index; the equivalent is a flat index stored as FP16
+        cloner_options = faiss.GpuClonerOptions()
+        cloner_options.useFloat16 = True
+        gpu_index = faiss.index_cpu_to_gpu(_gpu_resources, FAISS_GPU_DEVICE, faiss.IndexFlatIP(EMBEDDING_DIMENSION), cloner_options)
+        mirror = faiss.IndexIDMap(gpu_index)
+        if cpu_index.ntotal > 0:
+            mirror.add_with_ids(_stored_vectors(cpu_index), _stored_user_ids(cpu_index))
+        return mirror
+    except Exception as e:
+        print(f"Warning: Could not move FAISS index to GPU ({e}). Searching on CPU.")
+        return cpu_index
+
+
 def load_faiss_data():
-    global faiss_index, id_to_user_id_map, next_faiss_id
+    global faiss_index, search_index, _mapped_index, _user_embedding_counts, _snapshots_enabled
     _ensure_ml_models_dir_exists() # Ensure directory exists before trying to load/create files
 
-    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(ID_MAP_PATH):
+    try:
+        if os.path.exists(FAISS_INDEX_PATH):
+            # Vectors are served from the page cache instead of being read into the heap up front
+            faiss_index = _mapped_index = faiss.read_index(FAISS_INDEX_PATH, faiss.IO_FLAG_MMAP_IFC)
+            converted = False
+            if not isinstance(faiss_index, faiss.IndexIDMap2):
+                faiss_index = _convert_legacy_index(faiss_index)
+                converted = True
+            if faiss_index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                faiss_index = _convert_l2_index(faiss_index)
+                converted = True
+            if converted and save_faiss_data():
+                # Persist the conversion right away (the WAL still applies on top of it) so it runs
+                # once, and drop the pickled id map it made redundant
+                if os.path.exists(LEGACY_ID_MAP_PATH):
+                    os.remove(LEGACY_ID_MAP_PATH)
+            print(f"FAISS data loaded. Index size: {faiss_index.ntotal}")
+            _user_embedding_counts = Counter(_stored_user_ids(faiss_index).tolist())
+        else:
+            print("FAISS data not found. Initializing new index.")
+            faiss_index = _new_index()
+            _user_embedding_counts = Counter()
+        _replay_wal() # Everything added before the first snapshot lives only in the WAL
+        _snapshots_enabled = True
+    except Exception as e:
+        # Carry on with an empty index so the rest of the app works, but keep the data it failed
+        # to load out of the way of new WAL records, and never snapshot over it
+        moved = _move_aside(FAISS_INDEX_PATH, WAL_PATH)
+        print(f"ERROR: Could not load FAISS data ({e}). Registered faces are unavailable; "
+              f"moved aside for recovery: {', '.join(moved) or 'nothing'}. "
+              f"Snapshots are disabled until the data loads successfully.")
+        faiss_index = _new_index()
+        _mapped_index = None
+        _user_embedding_counts = Counter()
+        _snapshots_enabled = False
+    search_index = _mirror_to_gpu(faiss_index)
+
+def _move_aside(*paths):
+    """Renames the existing paths to <path>.unloadable-<timestamp> and returns the new names."""
+    suffix = f".unloadable-{int(time.time())}"
+    moved = []
+    for path in paths:
+        if os.path.exists(path):
+            try:
+                os.replace(path, path + suffix)
+                moved.append(path + suffix)
+            except OSError as e:
+                print(f"Error moving {path} aside: {e}")
+    return moved
+
+def _convert_legacy_index(legacy_index):
+    """
+    Rebuilds an index saved with positional ids (plus the pickled position -> user_id map)
+    as a user_id-keyed index. It is written in the new format on the next save.
+    """
+    with open(LEGACY_ID_MAP_PATH, 'rb') as f:
+        id_to_user_id_map = pickle.load(f)
+    user_ids = np.fromiter((id_to_user_id_map[i] for i in range(legacy_index.ntotal)),
+                           dtype=np.int64, count=legacy_index.ntotal)
+    vectors = legacy_index.reconstruct_n(0, legacy_index.ntotal)
+    faiss.normalize_L2(vectors) # Positional indexes all predate the switch to cosine similarity
+    return _build_index(vectors, user_ids)
+
+def _convert_l2_index(l2_index):
+    """Rebuilds an index saved with the L2 metric as an inner-product one over normalized vectors."""
+    vectors = _stored_vectors(l2_index)
+    faiss.normalize_L2(vectors)
+    return _build_index(vectors, _stored_user_ids(l2_index))
+
+def _replay_wal():
+    """Applies the WAL records written since the last snapshot. A torn final record is ignored."""
+    if not os.path.exists(WAL_PATH):
+        return
+    num_records = 0
+    with open(WAL_PATH, 'rb') as f:
+        if f.peek(1)[:1] == _PICKLE_PROTOCOL_MARKER:
+            _replay_pickled_wal(f)
+            return
+        while True:
+            header = f.read(_WAL_HEADER.size)
+            if len(header) < _WAL_HEADER.size:
+                break # End of log, or a header torn by a crash
+            op, user_id = _WAL_HEADER.unpack(header)
+            if op == _WAL_ADD:
+                vector = f.read(_WAL_VECTOR_SIZE)
+                if len(vector) < _WAL_VECTOR_SIZE:
+                    break
+                _add_embedding(user_id, np.frombuffer(vector, dtype=np.float32).reshape(1, -1))
+            elif op == _WAL_DELETE:
+                _delete_embeddings_by_user_id(user_id)
+            else:
+                print(f"Warning: Stopping FAISS WAL replay at a damaged record (operation {op!r}).")
+                break
+            num_records += 1
+    print(f"Replayed {num_records} FAISS WAL records.")
+
+def _replay_pickled_wal(f):
+    """
+    Replays a WAL of pickled tuples left by an older version, then snapshots so the log is
+    emptied before binary records are appended to it.
+    """
+    num_records = 0
+    while True:
         try:
-            faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-            with open(ID_MAP_PATH, 'rb') as f:
-                id_to_user_id_map = pickle.load(f)
-            # next_faiss_id should be the count of items if IDs are 0-indexed and contiguous
-            # or max_id + 1 if they are not strictly contiguous (though our add_embedding makes them so)
-            next_faiss_id = faiss_index.ntotal # This assumes all loaded IDs are contiguous from 0
-            if not id_to_user_id_map: # If map is empty, faiss_index.ntotal might be 0
-                 next_faiss_id = 0
-            elif max(id_to_user_id_map.keys(), default=-1) + 1 > next_faiss_id :
-                 # If map has higher keys than faiss_index.ntotal implies (e.g. after partial deletion/rebuild issues)
-                 # This logic might need refinement based on how robust the ID mapping is.
-                 # For simplicity, we assume ntotal is the source of truth for next_faiss_id upon load.
-                 # A more robust way if faiss_ids are not always 0..N-1 in map:
-                 if id_to_user_id_map:
-                     next_faiss_id = max(id_to_user_id_map.keys()) + 1
-                 else:
-                     next_faiss_id = 0
-
-
-            print(f"FAISS data loaded. Index size: {faiss_index.ntotal}, Map size: {len(id_to_user_id_map)}, Next FAISS ID: {next_faiss_id}")
-        except Exception as e:
-            print(f"Warning: Could not load FAISS data (files exist but loading failed: {e}). Re-initializing.")
-            faiss_index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-            id_to_user_id_map = {}
-            next_faiss_id = 0
+            record = pickle.load(f)
+        except EOFError:
+            break
+        except (pickle.UnpicklingError, ValueError) as e:
+            print(f"Warning: Stopping FAISS WAL replay at a damaged record: {e}")
+            break
+        if record[0] == 'add':
+            embedding = np.frombuffer(record[2], dtype=np.float32).reshape(1, -1).copy()
+            faiss.normalize_L2(embedding) # Records logged before the switch to cosine may not be
+            _add_embedding(record[1], embedding)
+        elif record[0] == 'del':
+            _delete_embeddings_by_user_id(record[1])
+        num_records += 1
+    print(f"Replayed {num_records} FAISS WAL records.")
+    if save_faiss_data():
+        open(WAL_PATH, 'wb').close()
+
+def _get_wal_file():
+    global _wal_file
+    if _wal_file is None:
+        _ensure_ml_models_dir_exists()
+        _wal_file = open(WAL_PATH, 'ab') # Positioned at the end, after any records not yet snapshotted
+    return _wal_file
+
+def _wal_append(op, user_id, vectors=None):
+    """Logs a mutation instead of rewriting the whole index; snapshot() folds the log back in."""
+    wal_file = _get_wal_file()
+    if vectors is None:
+        wal_file.write(_WAL_HEADER.pack(op, user_id))
     else:
-        print("FAISS data not found. Initializing new index and map.")
-        faiss_index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-        id_to_user_id_map = {}
-        next_faiss_id = 0
+        header = _WAL_HEADER.pack(op, user_id)
+        wal_file.write(b''.join(header + vector.tobytes() for vector in vectors)) # One record per vector
+    wal_file.flush() # Reaches the OS, so it survives a process crash
+
+def snapshot():
+    """
+    Writes the full index (atomically, via a temp file) and truncates the WAL.
+    Called periodically and at shutdown rather than on every mutation.
+    """
+    with _index_lock:
+        if not _snapshots_enabled:
+            return # The index was reset after a failed load; see load_faiss_data
+        wal_file = _get_wal_file()
+        if wal_file.tell() == 0:
+            return # Nothing logged since the last snapshot
+        if save_faiss_data():
+            wal_file.seek(0)
+            wal_file.truncate()
 
 def save_faiss_data():
-    global faiss_index, id_to_user_id_map
+    global faiss_index
     _ensure_ml_models_dir_exists() # Ensure directory exists before saving
 
     if faiss_index is None:
@@ -63,135 +288,206 @@ def save_faiss_data():
         return
 
     try:
-        faiss.write_index(faiss_index, FAISS_INDEX_PATH)
-        with open(ID_MAP_PATH, 'wb') as f:
-            pickle.dump(id_to_user_id_map, f)
-        # print(f"FAISS data saved. Index size: {faiss_index.ntotal}, Map size: {len(id_to_user_id_map)}")
+        faiss.write_index(faiss_index, FAISS_INDEX_PATH + ".tmp")
+        os.replace(FAISS_INDEX_PATH + ".tmp", FAISS_INDEX_PATH)
+        # print(f"FAISS data saved. Index size: {faiss_index.ntotal}")
+        return True
     except Exception as e:
         print(f"Error saving FAISS data: {e}")
+        return False
 
 
 def add_embedding(user_id: int, embedding: np.ndarray):
-    global faiss_index, id_to_user_id_map, next_faiss_id
+    """Adds a user's embedding and returns the index size afterwards (None if uninitialized)."""
+    global faiss_index, search_index
 
     if faiss_index is None:
         print("Error: FAISS index not initialized. Call load_faiss_data() first.")
         return None # Or raise an exception
 
-    if not isinstance(embedding, np.ndarray):
-        embedding = np.array(embedding) # Ensure it's a numpy array
-
-    if embedding.ndim == 1:
-        embedding = embedding.reshape(1, -1)
-    
-    if embedding.shape[1] != EMBEDDING_DIMENSION:
-        raise ValueError(f"Embedding dimension mismatch. Expected {EMBEDDING_DIMENSION}, got {embedding.shape[1]}")
+    embedding = _normalized_embedding(embedding)
+    with _index_lock:
+        _add_embedding(user_id, embedding)
+        _wal_append(_WAL_ADD, user_id, embedding)
+        return faiss_index.ntotal
 
-    embedding = embedding.astype(np.float32)
 
-    current_faiss_id = next_faiss_id # This is the internal ID for FAISS
-    
-    faiss_index.add(embedding)
-    id_to_user_id_map[current_faiss_id] = user_id
-    next_faiss_id += 1
-    
-    save_faiss_data()
-    return current_faiss_id
+def replace_embeddings(user_id: int, embedding: np.ndarray):
+    """
+    Replaces all of a user's embeddings with the given one (face re-registration). Equivalent to
+    delete_embeddings_by_user_id followed by add_embedding, but an HNSW index is rebuilt once
+    rather than twice.
+    :return: Tuple (number of embeddings removed, index size afterwards), or None if uninitialized.
+    """
+    if faiss_index is None:
+        print("Error: FAISS index not initialized. Call load_faiss_data() first.")
+        return None
+
+    embedding = _normalized_embedding(embedding)
+    with _index_lock:
+        rebuild = bool(_user_embedding_counts.get(user_id)) and _is_hnsw(faiss_index)
+        num_removed = _delete_embeddings_by_user_id(user_id, replacement=embedding if rebuild else None)
+        if not (rebuild and num_removed):
+            _add_embedding(user_id, embedding)
+        if num_removed:
+            _wal_append(_WAL_DELETE, user_id)
+        _wal_append(_WAL_ADD, user_id, embedding)
+        return num_removed, faiss_index.ntotal
+
+
+def _normalized_embedding(embedding: np.ndarray) -> np.ndarray:
+    """Validates an embedding and returns it as a unit-length (N, EMBEDDING_DIMENSION) array owned by the index."""
+    # Embeddings come from face_processor as float32 already; anything else is a caller bug,
+    # not something to paper over with a silent conversion
+    if not isinstance(embedding, np.ndarray) or embedding.dtype != np.float32:
+        raise ValueError(f"Embedding must be a float32 NumPy array, got {getattr(embedding, 'dtype', type(embedding))}")
+
+    prepared = _prepare(embedding)
+    if prepared.shape[1] != EMBEDDING_DIMENSION:
+        raise ValueError(f"Embedding dimension mismatch. Expected {EMBEDDING_DIMENSION}, got {prepared.shape[1]}")
+
+    if np.may_share_memory(prepared, embedding):
+        prepared = prepared.copy() # Normalized in place below; leave the caller's array untouched
+    faiss.normalize_L2(prepared)
+    return prepared
+
+
+def _ensure_writable():
+    """Replaces a memory-mapped faiss_index with an in-memory copy that can be modified."""
+    global faiss_index, search_index, _mapped_index
+    if faiss_index is None or faiss_index is not _mapped_index:
+        return
+    in_memory_index = faiss.deserialize_index(faiss.serialize_index(faiss_index))
+    if search_index is faiss_index:
+        search_index = in_memory_index
+    faiss_index = in_memory_index
+    _mapped_index = None
+
+
+def _add_embedding(user_id: int, embedding: np.ndarray):
+    global search_index
+    _ensure_writable()
+    user_ids = np.full(len(embedding), user_id, dtype=np.int64)
+    faiss_index.add_with_ids(embedding, user_ids)
+    _user_embedding_counts[user_id] += len(embedding)
+    if search_index is not None and search_index is not faiss_index:
+        try:
+            search_index.add_with_ids(embedding, user_ids)
+        except Exception as e:
+            # E.g. GPU out of memory: the mirror is now stale, so fall back to the CPU index
+            print(f"Warning: Could not add to the GPU FAISS mirror ({e}). Searching on CPU.")
+            search_index = faiss_index
+    if faiss_index.ntotal >= HNSW_MIN_SIZE and not _is_hnsw(faiss_index):
+        _switch_to_hnsw()
+
+
+def _switch_to_hnsw():
+    """Rebuilds the flat index as an HNSW graph once it has grown to HNSW_MIN_SIZE vectors."""
+    global faiss_index, search_index
+    hnsw_index = _build_index(_stored_vectors(faiss_index), _stored_user_ids(faiss_index))
+    if search_index is faiss_index: # A GPU mirror stays a brute-force scan; only the CPU index changes
+        search_index = hnsw_index
+    faiss_index = hnsw_index
+    print(f"FAISS index switched to HNSW at {faiss_index.ntotal} vectors.")
+
+
+def _prepare(vectors: np.ndarray) -> np.ndarray:
+    """
+    Returns vectors as the C-contiguous float32 (N, d) array FAISS works on. Arrays that
+    already are one come back as they are (a single vector only gains the batch axis), so
+    the common case costs no copy.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    return vectors.reshape(1, -1) if vectors.ndim == 1 else vectors
+
+
+def search_embeddings_batch(query_embeddings: np.ndarray, k: int = 1) -> list[list[tuple[int, float]]]:
+    """
+    Searches several query embeddings with a single index.search call, so the similarity
+    computation runs as one matrix product instead of one scan per query.
+    :param query_embeddings: (B, EMBEDDING_DIMENSION) array of query embeddings.
+    :param k: Number of neighbors per query.
+    :return: One list of (user_id, cosine similarity) tuples per query, most similar first
+             (empty lists if the index is empty).
+    """
+    global faiss_index
+
+    query_embeddings = _prepare(query_embeddings)
+    if query_embeddings.ndim != 2 or query_embeddings.shape[1] != EMBEDDING_DIMENSION:
+        raise ValueError(f"Query embedding dimension mismatch. Expected (B, {EMBEDDING_DIMENSION}), got {query_embeddings.shape}")
+
+    with _index_lock:
+        # Checked under the lock: mutations (HNSW switch, deletions) replace faiss_index
+        if faiss_index is None or faiss_index.ntotal == 0:
+            # print("FAISS index is empty or not initialized.")
+            return [[] for _ in range(query_embeddings.shape[0])]
+
+        # Determine the actual number of neighbors to search for (k_search)
+        # k_search cannot exceed faiss_index.ntotal
+        k_search = min(k, faiss_index.ntotal)
+        if k_search == 0: # Should be caught by faiss_index.ntotal == 0 above, but as a safeguard
+            return [[] for _ in range(query_embeddings.shape[0])]
+
+        similarities, user_ids = search_index.search(query_embeddings, k_search)
+
+    # Queries are not normalized (that would mean copying them); inner-product ranking does not
+    # depend on the query's length, and dividing by it turns the scores into cosine similarities
+    query_norms = np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+    query_norms[query_norms == 0] = 1.0
+    similarities /= query_norms
+
+    # tolist() converts both matrices to Python ints/floats in one C pass, instead of boxing a
+    # NumPy scalar per element. FAISS uses -1 for no valid neighbor found in that position.
+    return [[(user_id, similarity) for user_id, similarity in zip(id_row, similarity_row) if user_id != -1]
+            for id_row, similarity_row in zip(user_ids.tolist(), similarities.tolist())]
 
 
-def search_embedding(query_embedding: np.ndarray, k: int = 1) -> list[tuple[int, float]]:
-    global faiss_index, id_to_user_id_map
+def delete_embeddings_by_user_id(user_id_to_delete: int):
+    with _index_lock:
+        num_removed = _delete_embeddings_by_user_id(user_id_to_delete)
+        if num_removed:
+            _wal_append(_WAL_DELETE, user_id_to_delete)
+        return num_removed
 
-    if faiss_index is None or faiss_index.ntotal == 0:
-        # print("FAISS index is empty or not initialized.")
-        return []
-
-    if not isinstance(query_embedding, np.ndarray):
-        query_embedding = np.array(query_embedding)
-
-    if query_embedding.ndim == 1:
-        query_embedding = query_embedding.reshape(1, -1)
-    
-    if query_embedding.shape[1] != EMBEDDING_DIMENSION:
-        raise ValueError(f"Query embedding dimension mismatch. Expected {EMBEDDING_DIMENSION}, got {query_embedding.shape[1]}")
-
-    query_embedding = query_embedding.astype(np.float32)
-
-    # Determine the actual number of neighbors to search for (k_search)
-    # k_search cannot exceed faiss_index.ntotal
-    k_search = min(k, faiss_index.ntotal)
-    if k_search == 0: # Should be caught by faiss_index.ntotal == 0 above, but as a safeguard
-        return []
-
-    distances, internal_indices = faiss_index.search(query_embedding, k_search)
-    
-    results = []
-    for i in range(internal_indices.shape[1]): # Iterate through found neighbors for the first query
-        internal_id = internal_indices[0, i]
-        distance = distances[0, i]
-        
-        if internal_id == -1: # FAISS uses -1 for no valid neighbor found in that position
-            continue
-
-        user_id = id_to_user_id_map.get(internal_id)
-        if user_id is not None:
-            results.append((user_id, float(distance)))
-        else:
-            # This case should ideally not happen if the map and index are consistent
-            print(f"Warning: Internal FAISS ID {internal_id} not found in id_to_user_id_map.")
-            
-    return results
 
+def _delete_embeddings_by_user_id(user_id_to_delete: int, replacement=None):
+    """
+    Removes all of a user's embeddings; callers hold _index_lock.
+    :param replacement: Optional normalized embeddings to store for the user instead, added in the
+                        same rebuild when the index is HNSW (only pass it then).
+    """
+    global faiss_index, search_index
 
-def delete_embeddings_by_user_id(user_id_to_delete: int):
-    global faiss_index, id_to_user_id_map, next_faiss_id
-    
     if faiss_index is None or faiss_index.ntotal == 0:
         print("Cannot delete: FAISS index is empty or not initialized.")
         return 0
 
-    faiss_ids_to_remove = [fid for fid, uid in id_to_user_id_map.items() if uid == user_id_to_delete]
-    
-    if not faiss_ids_to_remove:
+    if not _user_embedding_counts.pop(user_id_to_delete, 0):
         print(f"No embeddings found for user_id {user_id_to_delete}.")
         return 0
 
-    # Rebuilding approach
-    new_index = faiss.IndexFlatL2(EMBEDDING_DIMENSION)
-    new_id_map = {}
-    current_new_id = 0
-    
-    # Iterate through all existing FAISS IDs from 0 to ntotal-1
-    # This is more robust than iterating id_to_user_id_map.keys() if map keys aren't guaranteed contiguous
-    num_removed = 0
-    temp_vectors_to_add = []
-
-    for old_faiss_id in range(faiss_index.ntotal):
-        if old_faiss_id in faiss_ids_to_remove:
-            num_removed +=1
-            continue # Skip this vector
-        
-        # Reconstruct vector and add to new index
-        vector = faiss_index.reconstruct(old_faiss_id) # reconstruct needs int ID
-        if vector is not None: # Check if reconstruction was successful
-            temp_vectors_to_add.append(vector.reshape(1, -1)) # Ensure 2D for add
-            original_user_id = id_to_user_id_map[old_faiss_id] # Get original user_id
-            new_id_map[current_new_id] = original_user_id
-            current_new_id += 1
-        else:
-            # This indicates an issue with the index or the ID.
-            print(f"Warning: Could not reconstruct vector for FAISS ID {old_faiss_id}. Skipping.")
-
-    if temp_vectors_to_add:
-        all_vectors_np = np.concatenate(temp_vectors_to_add, axis=0).astype(np.float32)
-        new_index.add(all_vectors_np)
-
-    faiss_index = new_index
-    id_to_user_id_map = new_id_map
-    next_faiss_id = current_new_id # The next ID is simply the count of items in the new map/index
-    
-    save_faiss_data()
-    print(f"Removed {num_removed} embeddings for user_id {user_id_to_delete}. Index rebuilt.")
+    if _is_hnsw(faiss_index):
+        # HNSW graphs cannot drop nodes, so rebuild from the surviving vectors
+        user_ids = _stored_user_ids(faiss_index)
+        keep = user_ids != user_id_to_delete
+        num_removed = len(user_ids) - int(np.count_nonzero(keep))
+        if num_removed:
+            vectors, user_ids = _stored_vectors(faiss_index)[keep], user_ids[keep]
+            if replacement is not None:
+                vectors = np.concatenate([vectors, replacement])
+                user_ids = np.concatenate([user_ids, np.full(len(replacement), user_id_to_delete, dtype=np.int64)])
+                _user_embedding_counts[user_id_to_delete] += len(replacement)
+            faiss_index = _build_index(vectors, user_ids, hnsw_min_size=HNSW_KEEP_SIZE)
+    else:
+        _ensure_writable()
+        num_removed = faiss_index.remove_ids(faiss.IDSelectorBatch(np.array([user_id_to_delete], dtype=np.int64)))
+
+    if not num_removed:
+        print(f"No embeddings found for user_id {user_id_to_delete}.")
+        return 0
+
+    search_index = _mirror_to_gpu(faiss_index) # GPU mirrors cannot remove ids; re-clone
+    print(f"Removed {num_removed} embeddings for user_id {user_id_to_delete}.")
     return num_removed
 
 
@@ -204,3 +500,7 @@ except Exception as e:
     # or functions above will fail if faiss_index is None.
     # For now, functions above have checks for None faiss_index.
     pass
+
+# Last-chance snapshot for processes that exit without the app's shutdown hook (scripts, crashes
+# in startup); a no-op when nothing was logged since the last one
+atexit.register(snapshot)
@@ -1,7 +1,7 @@
 import * as React from 'react';
 import {
     Edit, SimpleForm, TextInput, ReferenceManyField, Datagrid, TextField,
-    FileField, CreateButton, ReferenceInput, SelectInput, FunctionField, Button,
+    FileField, CreateButton, SelectInput, FunctionField, Button,
     useNotify, useRefresh, useRecordContext, useDataProvider, DeleteButton,
     TopToolbar, ShowButton, ListButton
 } from 'react-admin';
@@ -89,11 +89,50 @@ const LessonFileUpload = () => {
 };
 
 
+// /api/users returns pages of at most 500 users as { items, next_cursor }; follow the cursor to collect every student
+const USERS_PAGE_SIZE = 500;
+
+const useStudentChoices = () => {
+    const notify = useNotify();
+    const [students, setStudents] = React.useState([]);
+
+    React.useEffect(() => {
+        let cancelled = false;
+        const loadStudents = async () => {
+            const token = localStorage.getItem('token');
+            if (!token) return;
+            const collected = [];
+            let afterId = null;
+            try {
+                do {
+                    const params = new URLSearchParams({ limit: USERS_PAGE_SIZE });
+                    if (afterId != null) params.set('after_id', afterId);
+                    const response = await fetch(`${process.env.REACT_APP_API_URL || 'http://localhost:8000'}/api/users?${params}`, {
+                        headers: { 'Authorization': `Bearer ${token}` },
+                    });
+                    if (!response.ok) throw new Error('Could not load students');
+                    const page = await response.json();
+                    collected.push(...page.items.filter(user => user.role === 'student'));
+                    afterId = page.next_cursor;
+                } while (afterId != null);
+                if (!cancelled) setStudents(collected);
+            } catch (error) {
+                if (!cancelled) notify(`Error: ${error.message || 'Could not load students'}`, { type: 'warning' });
+            }
+        };
+        loadStudents();
+        return () => { cancelled = true; };
+    }, [notify]);
+
+    return students;
+};
+
 const EnrollStudentForm = () => {
     const record = useRecordContext();
     const notify = useNotify();
     const refresh = useRefresh();
     const [studentId, setStudentId] = React.useState('');
+    const students = useStudentChoices();
 
     const handleEnroll = async () => {
         if (!studentId || !record) return;
@@ -123,9 +162,7 @@ const EnrollStudentForm = () => {
     return (
         <Box sx={{ mt: 2, mb: 2, p: 2, border: '1px dashed grey', borderRadius: '4px' }}>
             <Typography variant="h6" gutterBottom>Enroll New Student</Typography>
-            <ReferenceInput label="Select Student" source="user_id_to_enroll" reference="users" filter={{ role: 'student' }} perPage={1000} sx={{ width: '100%', mb:1 }}>
-                <SelectInput optionText="username" onChange={(event) => setStudentId(event.target.value)} helperText={false} fullWidth />
-            </ReferenceInput>
+            <SelectInput label="Select Student" source="user_id_to_enroll" choices={students} optionText="username" onChange={(event) => setStudentId(event.target.value)} helperText={false} fullWidth sx={{ width: '100%', mb:1 }} />
             <Button label="Enroll Student" onClick={handleEnroll} disabled={!studentId} variant="contained" />
         </Box>
     );